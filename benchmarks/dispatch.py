@@ -0,0 +1,57 @@
+"""
+Microbenchmark for routing chat messages in callback_message
+
+Run from the repository root: python -m benchmarks.dispatch
+"""
+import os
+import timeit
+
+from lib.dispatch import Dispatcher
+from lib.game import Score
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus.txt')
+
+
+class Message:
+    def __init__(self, body):
+        self.body = body
+
+
+def handle(msg, score=None):
+    "Stand-in for the plugin's handlers"
+
+
+def legacy(msg):
+    "callback_message as it was: two lowercases, a regex match, then parsing again when adding"
+    if 'adam' in msg.body.lower():
+        handle(msg)
+    if 'bookiebot?' in msg.body.lower():
+        handle(msg)
+    if Score.regex.match(msg.body):
+        try:
+            handle(msg, Score.parse(msg.body))
+        except ValueError:
+            pass
+
+
+def main(repeat=40):
+    with open(CORPUS) as corpus:
+        messages = [Message(line.rstrip('\n')) for line in corpus]
+    dispatcher = Dispatcher()
+    dispatcher.on('adam', handle)
+    dispatcher.on('bookiebot?', handle)
+    dispatcher.on_score(handle)
+
+    def run(handler):
+        return min(timeit.repeat(lambda: [handler(msg) for msg in messages], number=5, repeat=repeat)) / 5
+
+    legacy_time = run(legacy)
+    dispatch_time = run(dispatcher.dispatch)
+    print('{} messages'.format(len(messages)))
+    for name, elapsed in (('legacy', legacy_time), ('dispatcher', dispatch_time)):
+        print('{:>10}: {:8.0f} messages/s'.format(name, len(messages) / elapsed))
+    print('   speedup: {:.2f}x'.format(legacy_time / dispatch_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+Benchmarks for the bot's hot paths under kickoff load
+
+Run from the repository root:
+
+    python -m benchmarks.suite           # compare against benchmarks/baseline.json
+    python -m benchmarks.suite --save    # record a new baseline
+
+Every benchmark plays a synthetic tournament (--players betting on
+--rounds concurrent rounds, with bursts of score messages in between
+chatter) and reports seconds per operation. The suite exits with status 1
+when a benchmark is more than --threshold slower than its baseline.
+Timings depend on the machine, so record a baseline on the machine you
+compare on.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+from lib.dispatch import Dispatcher
+from lib.game import Game, Match, Round
+from lib.outbox import Outbox
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+TEAMS = [
+    'Argentina', 'Australia', 'Belgium', 'Brazil', 'Cameroon', 'Canada', 'Costa Rica', 'Croatia',
+    'Denmark', 'Ecuador', 'England', 'France', 'Germany', 'Ghana', 'Iran', 'Japan',
+    'Korea Republic', 'Mexico', 'Morocco', 'Netherlands', 'Poland', 'Portugal', 'Qatar', 'Saudi Arabia',
+    'Senegal', 'Serbia', 'Spain', 'Switzerland', 'Tunisia', 'United States', 'Uruguay', 'Wales',
+]
+
+CHATTER = ['lunch?', 'the build is red again', 'who has the remote', 'deploying to staging', 'what a save', 'adam are you joining?']
+
+# Benchmark functions by name, in the order they run
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    "Register a benchmark, which takes a Tournament and returns seconds per operation"
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+class Tournament:
+    "Synthetic load: players betting on concurrent rounds in bursts"
+
+    def __init__(self, players=2000, rounds=4, messages=20000, burst=500, repeat=5, seed=0):
+        rng = random.Random(seed)
+        self.repeat = repeat
+        self.players = ['player{}'.format(number) for number in range(players)]
+        teams = rng.sample(TEAMS, rounds * 2)
+        self.fixtures = [teams[i:i + 2] for i in range(0, len(teams), 2)]
+        # Bursts of bets, like right before kickoff, with chatter in between
+        self.messages = []
+        while len(self.messages) < messages:
+            for _ in range(burst):
+                home, away = rng.choice(self.fixtures)
+                team = rng.choice([home, away])
+                # Mix up how people name teams, including the odd typo
+                name = rng.choice([team, team.lower(), team[:4], team[:4] + 'x'])
+                self.messages.append((rng.choice(self.players), '{}-{} {}'.format(rng.randint(0, 4), rng.randint(0, 4), name)))
+            for _ in range(burst // 2):
+                self.messages.append((rng.choice(self.players), rng.choice(CHATTER)))
+        del self.messages[messages:]
+        self.scores = [score for score in (Dispatcher.parse_score(body) for _, body in self.messages) if score]
+
+    def game(self):
+        "A game with every round of the tournament open"
+        game = Game()
+        for teams in self.fixtures:
+            game.new_round(Match(teams))
+        return game
+
+    def time(self, run, setup=lambda: None):
+        "Best time of running run on a fresh setup, over repeat runs"
+        best = float('inf')
+        for _ in range(self.repeat):
+            state = setup()
+            start = perf_counter()
+            run(state)
+            best = min(best, perf_counter() - start)
+        return best
+
+
+class Person:
+    def __init__(self, fullname):
+        self.fullname = fullname
+
+
+class Message:
+    "Just enough of a chat message for BookieBot.callback_message"
+
+    def __init__(self, author, body, to):
+        self.frm = Person(author)
+        self.body = body
+        self.to = to
+
+
+@benchmark
+def callback_message(tournament):
+    "Route every chat message through the plugin, placing and acknowledging bets on the game writer thread"
+    with running_bot() as (_, plugin, _):
+        shard = plugin.default
+        messages = [Message(author, body, shard.target) for author, body in tournament.messages]
+
+        def setup():
+            shard.set_game(tournament.game())
+            # Keep acknowledgements and replies from piling up in the test backend
+            plugin.outbox = Outbox(lambda target, text, in_reply_to: None)
+
+        def run(_):
+            for msg in messages:
+                plugin.callback_message(msg)
+
+        return tournament.time(run, setup) / len(messages)
+
+
+@benchmark
+def game_add(tournament):
+    "Place every parsed bet on the game directly"
+    def run(game):
+        for author, score in zip(itertools.cycle(tournament.players), tournament.scores):
+            try:
+                game.add(score, author)
+            except ValueError:
+                pass
+
+    return tournament.time(run, tournament.game) / len(tournament.scores)
+
+
+@benchmark
+def round_close(tournament):
+    "Award points for a round every player has bet on"
+    rng = random.Random(0)
+
+    def setup():
+        rnd = Round(Match(tournament.fixtures[0]))
+        for player in tournament.players:
+            rnd.add((rng.randint(0, 4), rng.randint(0, 4), tournament.fixtures[0][0]), player)
+        return rnd
+
+    return tournament.time(lambda rnd: rnd.close((2, 1, tournament.fixtures[0][0])), setup)
+
+
+@benchmark
+def game_scores(tournament):
+    "Sort the scoreboard of every player"
+    game = Game({player: number % 50 for number, player in enumerate(tournament.players)})
+    runs = 100
+    return tournament.time(lambda _: [game.scores for _ in range(runs)]) / runs
+
+
+@contextmanager
+def running_bot():
+    "A started test bot, fed by a local event feed"
+    from errbot.backends.test import TestBot
+    from lib.feed import EventFeed
+
+    bot = TestBot(extra_plugin_dir=ROOT, loglevel=logging.ERROR)
+    bot.start()
+    try:
+        plugin = bot.bot.plugin_manager.get_plugin_obj_by_name('BookieBot')
+        feed = EventFeed()
+        feed.subscribe(plugin.match_changed)
+        plugin.match_source = feed
+        yield bot, plugin, feed
+    finally:
+        bot.stop()
+
+
+def kickoff(number, teams):
+    "Event for a match that kicks off in an hour"
+    utc_date = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+    return {'id': number, 'utcDate': utc_date, 'status': 'TIMED', 'homeTeam': {'name': teams[0]}, 'awayTeam': {'name': teams[1]}}
+
+
+@benchmark
+def kickoff_latency(tournament):
+    "From a pushed kickoff event through the bot to its announcement"
+    samples = []
+    with running_bot() as (bot, _, feed):
+        for number, teams in enumerate(tournament.fixtures):
+            start = perf_counter()
+            feed.push(kickoff(number, teams))
+            bot.pop_message()
+            samples.append(perf_counter() - start)
+    return min(samples)
+
+
+@benchmark
+def command_latency(tournament):
+    "From a bet and a !scores command in chat to the bot's reply"
+    samples = []
+    with running_bot() as (bot, _, feed):
+        for number, teams in enumerate(tournament.fixtures):
+            feed.push(kickoff(number, teams))
+            bot.pop_message()
+        for _ in range(tournament.repeat):
+            start = perf_counter()
+            bot.push_message('!score 2-1 {}'.format(tournament.fixtures[0][0]))
+            bot.push_message('!scores')
+            bot.pop_message()
+            samples.append(perf_counter() - start)
+    return min(samples)
+
+
+def run(tournament, names=None):
+    "Run benchmarks and return their timings by name"
+    results = {}
+    for name, function in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        results[name] = function(tournament)
+        print('{:>16}: {:12.3f} us'.format(name, results[name] * 1e6), flush=True)
+    return results
+
+
+def regressions(results, baseline, threshold):
+    "Benchmarks that got more than threshold slower than their baseline, as (name, baseline, result)"
+    return [(name, baseline[name], result) for name, result in results.items() if name in baseline and result > baseline[name] * (1 + threshold)]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bot under kickoff load')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all of {})'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=4, help='concurrent rounds')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--burst', type=int, default=500, help='score messages in a row')
+    parser.add_argument('--repeat', type=int, default=5, help='runs to take the best time of')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, as a fraction of the baseline')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    options = parser.parse_args(args)
+    tournament = Tournament(options.players, options.rounds, options.messages, options.burst, options.repeat)
+    results = run(tournament, options.names)
+    if options.save or not os.path.exists(options.baseline):
+        with open(options.baseline, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(options.baseline))
+        return 0
+    with open(options.baseline) as baseline:
+        slower = regressions(results, json.load(baseline), options.threshold)
+    for name, old, new in slower:
+        print('{} regressed: {:.3f} us -> {:.3f} us ({:+.0%})'.format(name, old * 1e6, new * 1e6, new / old - 1))
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,151 +1,410 @@
 import json
-from time import time
+import os
+from time import perf_counter, time
 from datetime import datetime
+from urllib.parse import quote
 
 from errbot import BotPlugin, botcmd
 
-from lib.api import FootballDataAPI
-from lib.game import Game, GameError, Match, Score
-from lib.settings import EXACT_GUESS_POINTS, MAIN_ROOM, PRE_MATCH_BETTING_TIME
+from lib.api import Competitions
+from lib.dispatch import Dispatcher
+from lib.feed import EventFeed
+from lib.fetch import FetchError
+from lib.game import Game, GameError, Match
+from lib.history import History
+from lib.metrics import metrics
+from lib.outbox import Outbox
+from lib.scheduler import PollScheduler
+from lib.shard import Shard
+from lib.settings import JOURNAL_DIR, JOURNAL_SYNC_INTERVAL, MATCH_FEED, MAIN_ROOM, METRICS_FILE, METRICS_INTERVAL, NEW_MATCH_TIME_OFFSET, OUTBOX_FLUSH_INTERVAL, POLL_TICK, PRE_MATCH_BETTING_TIME, ROOMS, SCOREBOARD_PAGE_SIZE
 from lib.utils import string_join_and
 
+# Time every command and poller into its own histogram
+timed = metrics.timed('command_seconds', by='command')
+poller = metrics.timed('poller_seconds', by='poller')
+
 
 class BookieBot(BotPlugin):
     """Football Betting Bot for Err"""
-    match_source = FootballDataAPI()
+    match_source = EventFeed(MATCH_FEED) if MATCH_FEED else Competitions()
 
     def activate(self):
-        "Start game polling on activation"
+        "Restore games and start polling on activation"
+        start = perf_counter()
         super(BookieBot, self).activate()
-        self.game = self['game'] if 'game' in self else Game()
-        self.start_poller(60, self.start_matches)
-        self.start_poller(61, self.end_matches)
+        directory = JOURNAL_DIR or os.path.join(self.bot_config.BOT_DATA_DIR, 'bookiebot')
+        # Start from the fixtures of the last run, refreshing them in the background
+        self.match_source.persist(os.path.join(directory, 'fixtures'))
+        # One pool per room, keyed by the room messages arrive in
+        self.shards = {}
+        for room in ROOMS:
+            key = self.storage_key(room)
+            target = self.build_identifier(room)
+            # The main room keeps the journal directory from before there were several pools
+            self.shards[str(target)] = Shard(room, target, directory if room == MAIN_ROOM else os.path.join(directory, quote(room, safe='')), self[key] if key in self else None)
+        # Direct messages and other rooms go to the main room's pool, or the first pool if it has none
+        self.default = next((shard for shard in self.shards.values() if shard.room == MAIN_ROOM), next(iter(self.shards.values())))
+        self.start_poller(JOURNAL_SYNC_INTERVAL, self.sync_journal)
+        self.scheduler = PollScheduler()
+        self.start_poller(POLL_TICK, self.poll)
+        self.outbox = Outbox(lambda target, text, in_reply_to: self.send(target, text, in_reply_to=in_reply_to))
+        self.start_poller(OUTBOX_FLUSH_INTERVAL, self.flush_outbox)
+        if METRICS_FILE:
+            self.start_poller(METRICS_INTERVAL, self.write_metrics)
+        self.dispatcher = Dispatcher()
+        # Adam's easter egg
+        self.dispatcher.on('adam', lambda msg: self.respond(msg, "hey buddy"))
+        # Bookie bot's "hello world"
+        self.dispatcher.on('bookiebot?', lambda msg: self.respond(msg, "Affirmative, {}. I read you.".format(msg.frm.fullname)))
+        # Automatically detect correctly formatted score messages
+        self.dispatcher.on_score(lambda msg, score: self.respond(msg, self.bet(msg, score)))
+        # Push sources report kickoffs and final whistles without waiting for a poll
+        self.match_source.subscribe(self.match_changed)
+        self.match_source.start()
+        elapsed = perf_counter() - start
+        metrics.observe('activation_seconds', elapsed)
+        self.log.info('Activated in %.0fms', elapsed * 1000)
 
     def deactivate(self):
-        "Save game on deactivation"
-        self['game'] = self.game
+        "Save games on deactivation"
+        # Stop everything that changes games before their writers stop
+        for poller in list(self.current_pollers):
+            self.stop_poller(*poller)
+        for timer in self.current_timers:
+            timer.cancel()
+        self.match_source.unsubscribe(self.match_changed)
+        self.match_source.stop()
+        for shard in self.shards.values():
+            self[self.storage_key(shard.room)] = shard.stop()
         super(BookieBot, self).deactivate()
 
+    @staticmethod
+    def storage_key(room):
+        "Storage key of a pool's game, the main room keeps the key from before there were several"
+        return 'game' if room == MAIN_ROOM else 'game:{}'.format(room)
+
+    def shard(self, msg):
+        "Pool of the room a message came from, the default pool for direct messages and other rooms"
+        if msg is None:
+            return self.default
+        return self.shards.get(str(msg.to), self.default)
+
     @botcmd(admin_only=True)
-    def end_match(self, _, args):
+    @timed
+    def end_match(self, msg, args):
         """
         Close an ongoing match with a final score (Example: `!end match 2-1 England`)
         """
         try:
-            match, final_score, winners = self.game.close_round(args)
+            match, final_score = self.end_round(self.shard(msg), args)
         except ValueError:
             return "That score doesn't work for any of the active rounds."
-        self.announce("Final score: {}, {}".format(final_score, self.summarize(winners)))
-        self.announce(self.scoreboard(None, None))
         return "Closed match {} with {}".format(match, final_score)
 
+    def end_round(self, shard, final_score):
+        "Close a round of a pool and announce the winners in its room"
+        match, final_score, winners = shard.call('close_round', final_score)
+        view = shard.view
+        self.announce("Final score: {}, {}\n{}".format(final_score, self.summarize(winners, view.rules), self.show_scoreboard(view.scoreboard, '')), shard.target)
+        return match, final_score
+
     @botcmd(admin_only=True)
+    @timed
     def init(self, msg, args):
         "Restart the entire game"
-        self.game = Game()
+        self.shard(msg).set_game(Game())
         yield "Started game."
-        yield self.scoreboard(msg, args)
+        yield self.scoreboard(msg, '')
 
     @botcmd
-    def matches(self, _, dummy):
+    @timed
+    def matches(self, msg, dummy):
         "Show current matches"
-        if not self.game.active_rounds:
+        active_rounds = self.shard(msg).view.active_rounds
+        if not active_rounds:
             return "No currently active matches!"
-        return "Current matches in progress are {}".format(', '.join([str(rnd) for rnd in self.game.active_rounds]))
+        return "Current matches in progress are {}".format(', '.join([str(rnd) for rnd in active_rounds]))
 
     @botcmd(split_args_with=' vs. ', admin_only=True)
-    def start_match(self, _, args, uuid=None):
+    @timed
+    def start_match(self, msg, args):
         "Start a new round (Example: `!start match Germany vs. England`)"
-        match = Match(args, uuid)
-        self.game.new_round(match)
-        self.announce("Now taking bets for {}...".format(match))
-        return "Started match {}".format(match)
+        return "Started match {}".format(self.start_round(self.shard(msg), args))
+
+    def start_round(self, shard, teams, uuid=None, resolver=None):
+        "Start a round in a pool and announce it in its room"
+        match = Match(teams, uuid, resolver)
+        shard.call('new_round', match)
+        self.announce("Now taking bets for {}...".format(match), shard.target)
+        return match
+
+    @botcmd(admin_only=True)
+    @timed
+    def source_status(self, _, dummy):
+        "Show health of the match data source"
+        return self.match_source.status
+
+    @botcmd
+    @timed
+    def stats(self, msg, args):
+        """
+        Show the betting record of a player, or compare two (Examples: `!stats Joe`, `!stats Joe vs. Pete`)
+        """
+        history = self.shard(msg).view.history
+        player, _, rival = args.partition(' vs. ')
+        player = player.strip() or msg.frm.fullname
+        rival = rival.strip()
+        for name in (player, rival) if rival else (player,):
+            if name not in history:
+                return "{} has no closed bets yet.".format(name)
+        if rival:
+            closer, further, even = history.head_to_head(player, rival)
+            if not closer + further + even:
+                return "{} and {} have not bet on the same match yet.".format(player, rival)
+            return "{} vs. {}: {} closer {} time{}, {} closer {} time{}, even {} time{}.".format(
+                player, rival, player, closer, '' if closer == 1 else 's', rival, further, '' if further == 1 else 's', even, '' if even == 1 else 's',
+            )
+        stats = history[player]
+        return "{}: {} point{} from {} bet{}, {} exact ({:.0%}), {} right outcome{} ({:.0%}), off by {:.1f} goals on average, streak {} (best {}).".format(
+            player, stats.points, '' if stats.points == 1 else 's', stats.bets, '' if stats.bets == 1 else 's',
+            stats.exact, stats.exact_rate, stats.outcomes, '' if stats.outcomes == 1 else 's', stats.outcome_rate,
+            stats.average_error, stats.streak, stats.best_streak,
+        )
+
+    @botcmd(admin_only=True)
+    @timed
+    def stats_bot(self, _, dummy):
+        "Show response times of commands, messages, pollers and match fetches"
+        return metrics.summary()
+
+    @botcmd
+    @timed
+    def leaders(self, msg, args):
+        """
+        Rank players over all closed rounds by a statistic (Example: `!leaders exact_rate 5`)
+        """
+        history = self.shard(msg).view.history
+        metric, _, count = args.strip().partition(' ')
+        metric = metric or 'points'
+        if metric not in History.METRICS or (count and not count.strip().isdigit()):
+            return 'Use `!leaders <statistic> [number]` with one of: {}.'.format(', '.join(History.METRICS))
+        leaders = history.leaderboard(metric, max(int(count), 1) if count else 10)
+        if not leaders:
+            return 'Nobody qualifies yet.'
+        value = '{:.0%}' if metric in ('exact_rate', 'outcome_rate') else '{:.1f}' if metric == 'average_error' else '{}'
+        return '{}: {}'.format(metric, ' / '.join('{}:{}'.format(player, value.format(number)) for player, number in leaders))
 
     @botcmd
-    def scores(self, _, dummy):
-        "Show currently placed scores for each match"
-        for rnd in self.game.active_rounds:
-            for score in rnd.scores.values():
-                yield '{}: {}'.format(rnd, score)
+    @timed
+    def scores(self, msg, args):
+        """
+        Summarize placed scores for each match, or show the bets of a player (Example: `!scores Joe`)
+        """
+        active_rounds = self.shard(msg).view.active_rounds
+        if not active_rounds:
+            return "No currently active matches!"
+        player = args.strip()
+        if not player:
+            return '\n'.join(self.describe(rnd) for rnd in active_rounds)
+        bets = ['{}: {}'.format(rnd, bet) for rnd, bet in ((rnd, rnd.bet(player)) for rnd in active_rounds) if bet]
+        return '\n'.join(bets) if bets else "{} has no bets on the current matches.".format(player)
 
     @botcmd
+    @timed
     def score(self, msg, args):
         """
         Allow user to enter a score and play (Example: `!score 1-0 Germany`)
 
         Can be called automatically without !score via callback_message
         """
+        return self.bet(msg, args)
+
+    def bet(self, msg, score):
+        "Place a bet from a score string or parsed score, acknowledging it in the next digest"
         try:
-            score = self.game.add(args, msg.frm.fullname)
-            return "Thanks {}! I've noted {} for you.".format(msg.frm.fullname, score)
+            score = self.shard(msg).call('add', score, msg.frm.fullname)
+            self.outbox.acknowledge(msg.to, '{} {}'.format(msg.frm.fullname, score), msg)
         except GameError as error:
             return str(error)
         except ValueError:  # Ignore malformed scores
             pass
 
     @botcmd
-    def scoreboard(self, _, dummy):
-        "Display scoreboard with points"
-        if not self.game.scores:
+    @timed
+    def rank(self, msg, args):
+        "Show the rank of a player, yourself by default (Example: `!rank Joe`)"
+        player = args.strip() or msg.frm.fullname
+        scoreboard = self.shard(msg).view.scoreboard
+        if player not in scoreboard:
+            return "{} is not on the scoreboard.".format(player)
+        return "{} is {}#{} with {} point{}.".format(player, 'tied ' if scoreboard.tied(player) else '', scoreboard.rank(player), scoreboard.points[player], '' if scoreboard.points[player] == 1 else 's')
+
+    @botcmd
+    @timed
+    def scoreboard(self, msg, args):
+        """
+        Display scoreboard with points (Examples: `!scoreboard`, `!scoreboard top 10`, `!scoreboard page 2`)
+        """
+        return self.show_scoreboard(self.shard(msg).view.scoreboard, args)
+
+    @staticmethod
+    def show_scoreboard(scoreboard, args):
+        "Format a scoreboard, or part of it"
+        if not scoreboard:
             return 'Scoreboard is empty!'
+        command, _, number = args.strip().partition(' ')
+        if command and (command not in ('top', 'page') or not number.strip().isdigit()):
+            return 'Use `!scoreboard top <number>` or `!scoreboard page <number>`.'
+        suffix = ''
+        if command == 'top':
+            scores = scoreboard.top(max(int(number), 1))
         else:
-            return 'Scores: {}'.format(" / ".join(["{}:{}".format(*s) for s in self.game.scores]))
+            page = int(number) if number else 1
+            pages = scoreboard.pages(SCOREBOARD_PAGE_SIZE)
+            if not 1 <= page <= pages:
+                return 'Pick a page from 1 to {}.'.format(pages)
+            scores = scoreboard.page(page, SCOREBOARD_PAGE_SIZE)
+            if pages > 1:
+                suffix = ' (page {} of {})'.format(page, pages)
+        return 'Scores: {}{}'.format(" / ".join(["{}:{}".format(*s) for s in scores]), suffix)
 
     @botcmd(admin_only=True)
-    def scoreboard_set(self, _, args):
+    @timed
+    def scoreboard_set(self, msg, args):
         """
         Manually enter scoreboard data as a JSON object for a starting score list.
         """
-        self.game = Game(json.loads(args))
-        return self.scoreboard(None, None)
+        self.shard(msg).set_game(Game(json.loads(args)))
+        return self.scoreboard(msg, '')
 
     def callback_message(self, msg):
         "Listen to every message in a room"
-        # Adam's easter egg
-        if 'adam' in msg.body.lower():
-            self.respond(msg, "hey buddy")
-        # Bookie bot's "hello world"
-        if 'bookiebot?' in msg.body.lower():
-            self.respond(msg, "Affirmative, {}. I read you.".format(msg.frm.fullname))
-        # Automatically detect correctly formatted score messages
-        if Score.regex.match(msg.body):
-            self.respond(msg, self.score(msg, msg.body))
+        with metrics.timer('message_seconds'):
+            self.dispatcher.dispatch(msg)
 
     def end_matches(self):
         "Look for matches that have ended and close them if necessary"
-        for match in [self.match_source.get_match(rnd.match.uuid) for rnd in self.game.active_rounds if hasattr(rnd.match, 'uuid')]:
-            if match['status'] == 'FINISHED':
-                self.end_match(None, '{}-{} {}'.format(match['score']['fullTime']['home'], match['score']['fullTime']['away'], match['homeTeam']['name']))
+        ids = {rnd.match.uuid for rnd in self.active_rounds() if getattr(rnd.match, 'uuid', None) is not None}
+        for match in [self.match_source.get_match(id) for id in ids]:
+            if match:
+                self.finish_match(match)
+
+    def finish_match(self, match):
+        "Close the rounds of a match from the source in every pool, if it has finished"
+        if match['status'] != 'FINISHED':
+            return
+        final_score = '{}-{} {}'.format(match['score']['fullTime']['home'], match['score']['fullTime']['away'], match['homeTeam']['name'])
+        for shard in list(self.shards.values()):
+            if any(getattr(rnd.match, 'uuid', None) == match['id'] for rnd in shard.view.active_rounds):
+                try:
+                    self.end_round(shard, final_score)
+                except (GameError, ValueError):
+                    pass
+
+    def active_rounds(self):
+        "Active rounds of all pools"
+        return [rnd for shard in self.shards.values() for rnd in shard.view.active_rounds]
+
+    def match_changed(self, match):
+        "Start or close a round as soon as the match source reports a change"
+        if match.get('status') == 'FINISHED':
+            self.finish_match(match)
+        else:
+            self.open_match(match, self.match_source.index.teams)
+
+    @poller
+    def sync_journal(self):
+        for shard in list(self.shards.values()):
+            shard.sync()
+
+    @poller
+    def flush_outbox(self):
+        self.outbox.flush()
+
+    def write_metrics(self):
+        "Write metrics for the Prometheus textfile collector"
+        metrics.write(METRICS_FILE)
+
+    @poller
+    def poll(self):
+        "Check the match source for new and finished matches when the scheduler says so"
+        if not self.scheduler.due():
+            return
+        # Results are due, make sure the next poll sees fresh data
+        if self.scheduler.hot:
+            self.match_source.refresh(self.scheduler.overdue)
+        try:
+            self.start_matches()
+            self.end_matches()
+            index = self.match_source.index
+        except FetchError as error:
+            self.log.warning('Skipping poll: %s', error)
+            self.scheduler.backoff()
+            return
+        self.scheduler.plan(index, self.active_rounds(), self.match_source.stale)
 
     def respond(self, msg, text):
-        "Shortcut for send()"
-        self.send(msg.to, text, in_reply_to=msg)
+        "Reply to a message through the outbox"
+        if text:
+            self.outbox.post(msg.to, text, msg)
 
     def start_matches(self):
-        "Look for upcoming matches and start a new round if necessary"
-        for match in self.match_source.get_upcoming_matches():
-            # Only consider matches that are within PRE_MATCH_BETTING_TIME seconds of starting
-            if datetime.fromisoformat(match['utcDate']).timestamp() - time() > PRE_MATCH_BETTING_TIME:
+        "Look for matches that betting is open on and start a new round if necessary"
+        now = time()
+        index = self.match_source.index
+        # Only consider matches that are within PRE_MATCH_BETTING_TIME seconds of starting,
+        # or have started less than NEW_MATCH_TIME_OFFSET seconds ago
+        for match in index.between(now - NEW_MATCH_TIME_OFFSET, now + PRE_MATCH_BETTING_TIME):
+            self.start_rounds(match, index.teams)
+
+    def open_match(self, match, teams):
+        "Start a round for a single match from the source in every pool, if betting on it is open"
+        kickoff = datetime.fromisoformat(match['utcDate']).timestamp()
+        if -NEW_MATCH_TIME_OFFSET <= kickoff - time() <= PRE_MATCH_BETTING_TIME:
+            self.start_rounds(match, teams)
+
+    def start_rounds(self, match, teams):
+        "Start a round for a match from the source in every pool that does not have one yet"
+        for shard in list(self.shards.values()):
+            if any(getattr(rnd.match, 'uuid', None) == match['id'] for rnd in shard.view.active_rounds):
                 continue
             try:
-                self.start_match(None, [match['homeTeam']['name'], match['awayTeam']['name']], match['id'])
+                self.start_round(shard, [match['homeTeam']['name'], match['awayTeam']['name']], match['id'], teams)
             except GameError:
                 pass
 
-    def announce(self, msg):
-        print(f'announcing: {msg}')
-        "Send message to room"
-        room_id = self.build_identifier(MAIN_ROOM)
-        self.send(room_id, msg)
+    def announce(self, msg, target=None):
+        "Send message to the room of a pool, the default one if not given"
+        self.log.info('Announcing: %s', msg)
+        self.outbox.post(target or self.default.target, msg)
 
     @staticmethod
-    def summarize(winners):
+    def describe(rnd):
+        "Summarize the bets on a round"
+        total = sum(rnd.outcomes)
+        if not total:
+            return '{}: no bets yet'.format(rnd)
+        home, draw, away = rnd.outcomes
+        return '{}: {} bet{} ({} {} / draw {} / {} {}), picks: {}'.format(
+            rnd, total, 's' if total > 1 else '',
+            rnd.match.teams[0], home, draw, rnd.match.teams[1], away,
+            ', '.join('{} x{}'.format(score, count) for score, count in rnd.popular),
+        )
+
+    @staticmethod
+    def summarize(winners, rules):
         "Make pretty string summary of winners"
         if not winners:
             return "there are no winners!"
-        points = list(winners.values())[0]
-        if points == EXACT_GUESS_POINTS:
-            score_text = "for guessing the score correctly"
-        else:
-            score_text = "for being closest"
-        return '{} get{} {} point{} {}'.format(string_join_and(winners.keys()), '' if len(winners) > 1 else 's', points, 's' if points > 1 else '', score_text)
+        groups = {}
+        for winner, points in winners.items():
+            groups.setdefault(points, []).append(winner)
+        summary = ', '.join('{} get{} {} point{}'.format(string_join_and(names), '' if len(names) > 1 else 's', points, 's' if points > 1 else '') for points, names in sorted(groups.items(), reverse=True))
+        # Explain points if everybody won the same way
+        if len(groups) == 1 and not (rules.outcome or rules.goal_difference):
+            points = next(iter(groups))
+            if points == rules.exact:
+                summary += " for guessing the score correctly"
+            elif points == rules.closest:
+                summary += " for being closest"
+        return summary
@@ -0,0 +1,122 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class GameView:
+    """
+    Read-only copy of a game at one point in time.
+    """
+
+    def __init__(self, game, previous=None):
+        # Copies by id of their original, with the original and its version when copied
+        self.copies = {}
+        copies = previous.copies if previous is not None else {}
+
+        def copy(original, version):
+            "Copy of original, reusing the previous view's copy if nothing changed since"
+            entry = copies.get(id(original))
+            if entry is None or entry[0] is not original or entry[1] != version:
+                entry = original, version, original.copy()
+            self.copies[id(original)] = entry
+            return entry[2]
+
+        # Only rounds bet on since the previous view are copied again
+        self.active_rounds = frozenset(copy(rnd, rnd.version) for rnd in game.active_rounds)
+        # The scoreboard only changes when a new player bets or a round closes
+        self.scoreboard = copy(game.scoreboard, game.scoreboard.version)
+        self.rules = game.rules
+        # History only changes when rounds close
+        self.history = copy(game.history, game.history.rounds)
+
+    @property
+    def scores(self):
+        return list(self.scoreboard)
+
+
+class GameActor:
+    """
+    Single writer in front of a game.
+
+    Changes are queued and run one at a time on a worker thread.
+    After each batch of changes a fresh GameView is published, so
+    readers never need a lock and never see a half-applied change.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.view = GameView(game)
+        self.queue = queue.SimpleQueue()
+        self.stopped = False
+        # Keeps changes from being queued behind the stop marker, where nothing would run them
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='Game writer', daemon=True)
+        self.thread.start()
+
+    def call(self, method, *args, timeout=None):
+        """
+        Run a game method (by name) or a callable taking the game on the writer thread
+
+        Waits for and returns its result, or raises its exception
+        """
+        return self.submit(method, *args).result(timeout)
+
+    def submit(self, method, *args):
+        "Queue a change, returning a future for its result, which fails once the writer has stopped"
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # Changes made by changes run right away
+            self.resolve(future, *self.execute(method, args))
+            return future
+        with self._lock:
+            if self.stopped:
+                future.set_exception(RuntimeError('Game writer has stopped'))
+            else:
+                self.queue.put((future, method, args))
+        return future
+
+    def switch(self, game, prepare=None):
+        "Replace the game once all changes queued before are done"
+        def swap(_):
+            if prepare:
+                prepare(game)
+            self.game = game
+        return self.call(swap)
+
+    def stop(self):
+        "Finish queued changes and stop the writer"
+        with self._lock:
+            self.stopped = True
+            self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Handle everything that queued up in one go
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            outcomes = [(future, self.execute(method, args)) for future, method, args in filter(None, batch)]
+            # Publish changes before anyone hears back, so they can read their own writes
+            self.view = GameView(self.game, self.view)
+            for future, outcome in outcomes:
+                self.resolve(future, *outcome)
+            if None in batch:
+                return
+
+    def execute(self, method, args):
+        "Run a change, returning its result and exception"
+        try:
+            return method(self.game, *args) if callable(method) else getattr(self.game, method)(*args), None
+        except Exception as error:
+            return None, error
+
+    @staticmethod
+    def resolve(future, result, error):
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
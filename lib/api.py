@@ -1,39 +1,325 @@
-import operator
-import requests
+import functools
+import heapq
+import logging
+import os
+import pickle
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from time import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-from lib.settings import API_KEY, NEW_MATCH_TIME_OFFSET
+from lib.cache import RefreshingCache
+from lib.fetch import Fetcher, FetchError
+from lib.metrics import metrics
+from lib.ratelimit import TokenBucket
+from lib.settings import API_CALLS_PER_MINUTE, API_KEY, COMPETITIONS, FETCH_DAYS_AFTER, FETCH_DAYS_BEFORE, FETCH_WORKERS, NEW_MATCH_TIME_OFFSET
+from lib.teams import TeamResolver
 
+log = logging.getLogger(__name__)
 
-class FootballDataAPI:
+
+class MatchIndex:
     """
-    Quick and dirty implementation of the FIFA data stream
+    Lookup structure over a list of API matches,
+    rebuilt once per fetch.
     """
-    URL = 'https://api.football-data.org/v4/competitions/WC/matches'
-    CACHE_TIME = 300  # 5 Minutes
-    _data = None
-    _data_time = None
+
+    def __init__(self, matches=()):
+        self.by_id = {match['id']: match for match in matches}
+        # Parallel arrays sorted by kickoff time for bisecting
+        ordered = sorted((datetime.fromisoformat(match['utcDate']).timestamp(), match['id']) for match in matches)
+        self.kickoffs = [entry[0] for entry in ordered]
+        self.matches = [self.by_id[entry[1]] for entry in ordered]
+        self.teams = TeamResolver.from_matches(self.matches)
+
+    def __len__(self):
+        return len(self.matches)
+
+    @classmethod
+    def merge(cls, indexes):
+        "Combine several indexes into one"
+        index = cls()
+        entries = list(heapq.merge(*(zip(other.kickoffs, other.matches) for other in indexes), key=itemgetter(0)))
+        index.kickoffs = [kickoff for kickoff, _ in entries]
+        index.matches = [match for _, match in entries]
+        for other in indexes:
+            index.by_id.update(other.by_id)
+        index.teams = TeamResolver.from_matches(index.matches)
+        return index
+
+    def get(self, id):
+        "Get match by ID"
+        return self.by_id.get(id)
+
+    def since(self, timestamp):
+        "Get matches kicking off at or after timestamp, ordered by kickoff"
+        return self.matches[bisect_left(self.kickoffs, timestamp):]
+
+    def between(self, start, end):
+        "Get matches kicking off between two timestamps, ordered by kickoff"
+        return self.matches[bisect_left(self.kickoffs, start):bisect_left(self.kickoffs, end)]
+
+
+class MatchSource(ABC):
+    """
+    Where match data comes from.
+
+    Every source offers a MatchIndex of the matches it knows about.
+    Polling sources leave it to callers to check the index now and then,
+    push sources also pass every changed match to their subscribers
+    as soon as they hear about it.
+    """
+    stale = False
+    status = ''
+
+    def __init__(self):
+        self.listeners = []
 
     @property
-    def data(self):
-        "Facade to cache API data"
-        if not self._data or time() - self._data_time > self.CACHE_TIME:
-            headers = {'X-Auth-Token': API_KEY}
-            self._data = requests.get(self.URL, headers=headers).json()
-            self._data_time = time()
-        return self._data
+    @abstractmethod
+    def index(self):
+        "Match index of all known matches"
 
     def get_match(self, id):
         "Get specific match information"
-        all_matches = self.data['matches']
-        for match in all_matches:
-            if match['id'] == id:
-                return match
+        return self.index.get(id)
 
     def get_upcoming_matches(self):
         "Get upcoming matches"
-        all_matches = self.data['matches']
         # Include matches that have started less than 30 min ago
-        upcoming = [match for match in all_matches if datetime.fromisoformat(match['utcDate']).timestamp() > (time() - NEW_MATCH_TIME_OFFSET)]
-        return sorted(upcoming, key=operator.itemgetter('utcDate'))
+        return self.index.since(time() - NEW_MATCH_TIME_OFFSET)
+
+    def refresh(self, ids=None):
+        "Request fresh data in the background, if the source needs it, for the given match IDs or everything"
+        return False
+
+    def persist(self, directory):
+        "Keep the latest match data in a directory, to start from after a restart"
+
+    def start(self):
+        "Start listening for changes"
+
+    def stop(self):
+        "Stop listening for changes"
+
+    def subscribe(self, listener):
+        "Call listener with every match that changes"
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def emit(self, match):
+        "Pass a changed match on to all subscribers"
+        for listener in list(self.listeners):
+            try:
+                listener(match)
+            except Exception:
+                log.exception('Match listener failed on match %s', match.get('id'))
+
+
+class FootballDataAPI(MatchSource):
+    """
+    Quick and dirty implementation of the FIFA data stream
+    """
+    URL = 'https://api.football-data.org/v4/competitions/{}/matches'
+    CACHE_TIME = 300  # 5 Minutes
+
+    def __init__(self, url=None, competition='WC', quota=None, executor=None):
+        super().__init__()
+        self.competition = competition
+        self.fetcher = Fetcher(url or self.URL.format(competition), headers={'X-Auth-Token': API_KEY}, quota=quota, validate=self.validate)
+        # Snapshot of the latest fixtures, see persist()
+        self.path = None
+        self.cache = RefreshingCache(self.fetch, self.CACHE_TIME, executor, self.load)
+        for stat in ('hits', 'misses', 'refreshes'):
+            metrics.gauge('match_cache_{}'.format(stat), functools.partial(getattr, self.cache, stat), competition=competition)
+
+    @property
+    def data(self):
+        "Facade to cache API data"
+        return self.cache.get()[0]
+
+    def fetch(self):
+        "Download match data and index it"
+        data, changed = self.fetcher.get(self.window())
+        # Unchanged payloads can keep their index
+        if changed or self.cache.value is None:
+            value = data, MatchIndex(data['matches'])
+            self.save(value)
+            return value
+        return data, self.cache.value[1]
+
+    @staticmethod
+    def validate(data):
+        "Reject payloads without matches, like errors about restricted competitions"
+        if 'matches' not in data:
+            raise ValueError('No matches in payload: {}'.format(data.get('message', data)))
+
+    def persist(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, '{}.pickle'.format(self.competition))
+
+    def save(self, value):
+        "Write fixtures, their index and what is needed to revalidate them to the snapshot"
+        if not self.path:
+            return
+        snapshot = {
+            'value': value,
+            'time': time(),
+            'params': self.fetcher.params,
+            'etag': self.fetcher.etag,
+            'last_modified': self.fetcher.last_modified,
+        }
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'wb') as snapshot_file:
+                pickle.dump(snapshot, snapshot_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path)
+        except OSError:
+            log.warning('Could not save fixtures to %s', self.path, exc_info=True)
+
+    def load(self):
+        "Read the snapshot as the cached (value, time), so the first lookup does not wait for the network"
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except Exception:
+            log.warning('Ignoring unreadable fixtures in %s', self.path, exc_info=True)
+            return None
+        # Revalidate rather than download everything again
+        self.fetcher.data = snapshot['value'][0]
+        self.fetcher.params = snapshot['params']
+        self.fetcher.etag = snapshot['etag']
+        self.fetcher.last_modified = snapshot['last_modified']
+        return snapshot['value'], snapshot['time']
+
+    def refresh(self, ids=None):
+        "Request fresh data in the background"
+        return self.cache.refresh()
+
+    @property
+    def stale(self):
+        return self.cache.stale
+
+    @property
+    def status(self):
+        "Summary of fetch health"
+        if self.cache.time is None:
+            age = 'no data yet'
+        else:
+            age = 'data is {:.0f}s old'.format(time() - self.cache.time)
+        return 'Circuit breaker {}, {}, cache {hits} hits / {misses} misses / {refreshes} refreshes'.format(self.fetcher.breaker, age, **self.cache.stats)
+
+    @staticmethod
+    def window():
+        "Date range of matches to request, relative to today"
+        today = datetime.now(timezone.utc).date()
+        return {
+            'dateFrom': (today - timedelta(days=FETCH_DAYS_BEFORE)).isoformat(),
+            'dateTo': (today + timedelta(days=FETCH_DAYS_AFTER)).isoformat(),
+        }
+
+    @property
+    def index(self):
+        "Match index for the currently cached data"
+        return self.cache.get()[1]
+
+
+class Competitions(MatchSource):
+    """
+    Match data for several competitions at once.
+
+    Every competition has its own cache and index. Fetches run on a
+    bounded thread pool and share the rate limit of the API key.
+    Lookups go through one index merged from all competitions.
+    """
+
+    def __init__(self, codes=COMPETITIONS, workers=FETCH_WORKERS, calls_per_minute=API_CALLS_PER_MINUTE):
+        super().__init__()
+        self.quota = TokenBucket(calls_per_minute, calls_per_minute / 60)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Match fetcher')
+        self.sources = {}
+        self.directory = None
+        # Latest fetch error per competition, until it fetches again
+        self.errors = {}
+        # Stand-in for competitions without any data, shared so the merged index can be kept
+        self._empty = MatchIndex()
+        self._merged = ((), self._empty)
+        self._lock = threading.Lock()
+        for code in codes:
+            self.add(code)
+
+    def add(self, code, url=None):
+        "Start tracking a competition"
+        self.sources[code] = source = FootballDataAPI(url, code, self.quota, self.pool)
+        if self.directory:
+            source.persist(self.directory)
+
+    def remove(self, code):
+        "Stop tracking a competition"
+        del self.sources[code]
+        self.errors.pop(code, None)
+
+    def persist(self, directory):
+        self.directory = directory
+        for source in self.sources.values():
+            source.persist(directory)
+
+    @property
+    def index(self):
+        "Match index across all competitions"
+        sources = list(self.sources.items())
+        # Competitions without any data yet block, so fetch those in parallel
+        if any(source.cache.value is None for _, source in sources):
+            indexes = tuple(self.pool.map(self._index, sources))
+        else:
+            indexes = tuple(map(self._index, sources))
+        # Only merge again if any competition got a new index
+        with self._lock:
+            merged_from, merged = self._merged
+            if len(merged_from) != len(indexes) or any(old is not new for old, new in zip(merged_from, indexes)):
+                merged = MatchIndex.merge(indexes)
+                self._merged = indexes, merged
+        return merged
+
+    def _index(self, entry):
+        "Index of one competition, without letting its failure take down the others"
+        code, source = entry
+        try:
+            index = source.index
+        except FetchError as error:
+            log.warning('No matches for competition %s: %s', code, error)
+            self.errors[code] = error
+            # Keep the last good index if there is one
+            return source.cache.value[1] if source.cache.value else self._empty
+        self.errors.pop(code, None)
+        return index
+
+    def refresh(self, ids=None):
+        "Request fresh data in the background for the competitions of the given match IDs, or all of them"
+        sources = list(self.sources.values())
+        if ids is not None:
+            # Only competitions whose data has the matches, so the others keep their share of the quota
+            sources = [source for source in sources if source.cache.value and not ids.isdisjoint(source.cache.value[1].by_id)]
+        return any([source.refresh() for source in sources])
+
+    @property
+    def stale(self):
+        return any(source.stale for source in self.sources.values())
+
+    @property
+    def status(self):
+        "Summary of fetch health per competition"
+        lines = []
+        for code, source in self.sources.items():
+            line = '{}: {}'.format(code, source.status)
+            if code in self.errors:
+                line += ', last fetch failed: {}'.format(self.errors[code])
+            lines.append(line)
+        return '\n'.join(lines)
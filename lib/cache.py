@@ -0,0 +1,84 @@
+import logging
+import threading
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class RefreshingCache:
+    """
+    Cache for a single value that is refreshed in the background once stale.
+
+    Only one fetch is ever in flight. Callers only block when
+    there is no value at all, otherwise they get the stale value
+    while a refresh runs.
+    """
+
+    def __init__(self, fetch, max_age, executor=None, load=None):
+        self.fetch = fetch
+        self.max_age = max_age
+        # Optional callable returning a (value, time) saved by an earlier run, or None
+        self.load = load
+        # Optional concurrent.futures executor to refresh on, instead of a new thread
+        self.executor = executor
+        self.value = None
+        self.time = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        "Get cached value, fetching it if necessary"
+        if self.time is None:
+            with self._lock:
+                # Another caller may have fetched while we were waiting
+                if self.time is None:
+                    saved = self.load() if self.load else None
+                    if saved is None:
+                        self.misses += 1
+                        self._store(self.fetch())
+                        return self.value
+                    # Serve the saved value, refreshing it below if it is stale
+                    self.value, self.time = saved
+        self.hits += 1
+        if self.stale:
+            self.refresh()
+        return self.value
+
+    def refresh(self):
+        "Start a background refresh unless one is already running"
+        if not self._lock.acquire(blocking=False):
+            return False
+        self.refreshes += 1
+        if self.executor:
+            self.executor.submit(self._refresh)
+        else:
+            threading.Thread(target=self._refresh, daemon=True).start()
+        return True
+
+    def wait(self):
+        "Block until any running refresh has finished"
+        with self._lock:
+            pass
+
+    @property
+    def stale(self):
+        return self.time is None or time() - self.time > self.max_age
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes}
+
+    def _refresh(self):
+        try:
+            self._store(self.fetch())
+        except Exception:
+            log.exception('Refresh failed, keeping stale value')
+        finally:
+            self._lock.release()
+
+    def _store(self, value):
+        # Swap value before time so readers never see a fresh time with an old value
+        self.value = value
+        self.time = time()
@@ -0,0 +1,58 @@
+from lib.game import Score
+
+DIGITS = frozenset('0123456789')
+SCORE = Score.regex
+# First characters of messages that can be scores, the score pattern skips leading whitespace
+STARTS = DIGITS | frozenset(' \t\n\r\f\v')
+
+
+class Dispatcher:
+    """
+    Routes chat messages to handlers in a single pass.
+
+    The message is lowercased once to check all keyword triggers,
+    and only messages starting with a digit or whitespace are
+    matched against the score pattern.
+    """
+
+    def __init__(self):
+        self.triggers = ()
+        self.score_handler = None
+
+    def on(self, keyword, handler):
+        "Call handler(msg) for messages containing a keyword (case insensitive)"
+        self.triggers += ((keyword.lower(), handler),)
+
+    def on_score(self, handler):
+        "Call handler(msg, parsed_score) for messages that are scores"
+        self.score_handler = handler
+
+    def dispatch(self, msg):
+        "Run all handlers that apply to a message"
+        body = msg.body
+        if not body:
+            return
+        if self.triggers:
+            lowered = body.lower()
+            for keyword, handler in self.triggers:
+                if keyword in lowered:
+                    handler(msg)
+        # Score.parse inlined, because this runs for every message in the room
+        if self.score_handler and body[0] in STARTS:
+            match = SCORE.match(body)
+            if match:
+                home, away, team = match.groups()
+                self.score_handler(msg, (int(home), int(away), team))
+
+    @staticmethod
+    def parse_score(body):
+        "Parse a message as a score, or return None if it isn't one"
+        # Scores start with a digit, which rules out nearly all chatter without a regex
+        if body[0] not in DIGITS:
+            body = body.lstrip()
+            if not body or body[0] not in DIGITS:
+                return None
+        try:
+            return Score.parse(body)
+        except ValueError:
+            return None
@@ -0,0 +1,108 @@
+import json
+import logging
+import threading
+from time import time
+
+from lib.api import MatchIndex, MatchSource
+from lib.settings import FEED_POLL_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+class EventFeed(MatchSource):
+    """
+    Match source that is pushed to instead of polled.
+
+    Events are matches shaped like football-data.org's, and only need an
+    `id` plus the fields that changed. Every event is merged into what is
+    known about its match and passed on to subscribers right away, so a
+    final whistle closes its round without waiting for the next poll.
+
+    Events can be pushed directly, or read from a JSON lines file that
+    another process (a webhook receiver, a stream client or a person
+    with a text editor) appends to.
+    """
+
+    def __init__(self, path=None, interval=FEED_POLL_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.interval = interval
+        self.matches = {}
+        self.events = 0
+        self.last_event = None
+        self._index = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def index(self):
+        "Match index of all matches seen so far, rebuilt after changes"
+        with self._lock:
+            if self._index is None:
+                self._index = MatchIndex(list(self.matches.values()))
+            return self._index
+
+    @property
+    def status(self):
+        "Summary of feed activity"
+        if self.last_event is None:
+            age = 'no events yet'
+        else:
+            age = 'last one {:.0f}s ago'.format(time() - self.last_event)
+        return 'Event feed {}: {} events for {} matches, {}'.format(self.path or '(direct)', self.events, len(self.matches), age)
+
+    def push(self, event):
+        "Take in a match event and pass the updated match on to subscribers"
+        with self._lock:
+            match = dict(self.matches.get(event['id'], {}), **event)
+            self.matches[match['id']] = match
+            self._index = None
+            self.events += 1
+            self.last_event = time()
+        self.emit(match)
+        return match
+
+    def start(self):
+        "Follow the feed file in the background"
+        if self.path and self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.follow, name='Match feed', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def follow(self):
+        "Push every line of the feed file as an event, waiting for new lines at the end"
+        feed = None
+        partial = ''
+        try:
+            while not self._stopped.is_set():
+                if feed is None:
+                    try:
+                        feed = open(self.path)
+                    except FileNotFoundError:
+                        self._stopped.wait(self.interval)
+                        continue
+                line = feed.readline()
+                if not line:
+                    self._stopped.wait(self.interval)
+                    continue
+                # The writer may not have finished the line yet
+                partial += line
+                if not partial.endswith('\n'):
+                    continue
+                line, partial = partial, ''
+                if not line.strip():
+                    continue
+                try:
+                    self.push(json.loads(line))
+                except (ValueError, TypeError, KeyError):
+                    log.warning('Skipping malformed match event: %r', line)
+        finally:
+            if feed is not None:
+                feed.close()
@@ -0,0 +1,137 @@
+import random
+from time import perf_counter, sleep, time
+
+from lib.metrics import metrics
+from lib.settings import BREAKER_RESET_TIME, BREAKER_THRESHOLD, FETCH_BACKOFF, FETCH_RETRIES, FETCH_TIMEOUT
+
+
+class FetchError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream that keeps failing,
+    trying again after a cool-off period.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_time=BREAKER_RESET_TIME):
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+
+    def __str__(self):
+        if self.state == 'open':
+            return 'open for another {:.0f}s after {} failures'.format(self.opened_at + self.reset_time - time(), self.failures)
+        return '{} ({} failures)'.format(self.state, self.failures)
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time() - self.opened_at < self.reset_time:
+            return 'open'
+        # Cool-off period is over, allow a trial call
+        return 'half-open'
+
+    def allow(self):
+        "Check whether a call may go through"
+        return self.state != 'open'
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time()
+
+
+class Fetcher:
+    """
+    Pooled HTTP client for a JSON endpoint
+    that only downloads payloads that have changed.
+    """
+
+    def __init__(self, url, headers=None, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, breaker=None, quota=None, validate=None):
+        self.url = url
+        # Optional callable raising ValueError for payloads that decode but are unusable
+        self.validate = validate
+        # Optional lib.ratelimit.TokenBucket shared with other fetchers using the same API key
+        self.quota = quota
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.headers = dict({'Accept-Encoding': 'gzip'}, **(headers or {}))
+        self._session = None
+        self.data = None
+        self.params = None
+        self.etag = None
+        self.last_modified = None
+
+    @property
+    def session(self):
+        "HTTP session, created on first use because requests is slow to import"
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+            self._session.headers.update(self.headers)
+        return self._session
+
+    def get(self, params=None):
+        """
+        Fetch payload for the given query parameters
+
+        Returns a tuple of the decoded payload and whether it changed since the last call
+        """
+        import requests
+        if not self.breaker.allow():
+            raise FetchError('Not calling {}, circuit breaker is {}'.format(self.url, self.breaker))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Full jitter, so retrying clients don't hit the upstream in lockstep
+                sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            try:
+                result = self.request(params)
+            except (requests.RequestException, ValueError) as exc:
+                metrics.count('fetch_errors_total', error=type(exc).__name__)
+                error = exc
+            else:
+                self.breaker.success()
+                return result
+        self.breaker.failure()
+        raise FetchError('Fetching {} failed: {}'.format(self.url, error)) from error
+
+    def request(self, params):
+        "Make a single request, raising on any error or malformed payload"
+        headers = {}
+        # Only revalidate if we are asking for the same thing as last time
+        if self.data is not None and params == self.params:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        if self.quota:
+            self.quota.wait()
+        start = perf_counter()
+        response = self.session.get(self.url, params=params, headers=headers, timeout=self.timeout)
+        metrics.observe('fetch_seconds', perf_counter() - start)
+        metrics.count('fetch_responses_total', status=str(response.status_code))
+        # Bytes on the wire, before decompressing
+        metrics.count('fetch_bytes_total', int(response.headers.get('Content-Length') or len(response.content)))
+        if response.status_code == 304:
+            return self.data, False
+        response.raise_for_status()
+        data = response.json()
+        if not isinstance(data, dict):
+            raise ValueError('Unexpected payload: {!r}'.format(data))
+        if self.validate:
+            self.validate(data)
+        self.data = data
+        self.params = params
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        return self.data, True
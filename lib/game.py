@@ -1,53 +1,121 @@
 import operator
 import re
+import sys
+from array import array
+from collections import Counter
 
-from lib.settings import EXACT_GUESS_POINTS, CLOSEST_GUESS_POINTS
+from lib.history import History
+from lib.rules import GOALS, RuleSet, scoreline, sign
+from lib.scoreboard import Scoreboard
+from lib.teams import TeamResolver
 
 
 class GameError(Exception):
     pass
 
 
+class Slotted:
+    """
+    Pickle support for classes with __slots__,
+    accepting state saved before they had slots.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if hasattr(self, slot)}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
 class Game:
     """
     A game consists of a number of rounds,
     and a global scoreboard.
     """
 
-    def __init__(self, scores=None):
-        self.score_dict = scores if scores else {}
+    def __init__(self, scores=None, rules=None, history=None):
+        self.scoreboard = Scoreboard(scores)
+        self.rules = rules if rules else RuleSet.default()
+        # Player statistics, which outlive the game when it is restarted
+        self.history = history if history is not None else History()
         self.active_rounds = set()
+        # Team names and aliases of active rounds
+        self.teams = {}
+        self.resolver = TeamResolver()
+        # Optional lib.journal.Journal to record changes to
+        self.journal = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['journal']
+        return state
+
+    def __setstate__(self, state):
+        "Fill in anything games saved by older versions are missing"
+        self.__dict__.update(state)
+        self.journal = None
+        if 'score_dict' in state:
+            self.scoreboard = Scoreboard(self.__dict__.pop('score_dict'))
+        if 'rules' not in state:
+            self.rules = RuleSet.default()
+            for rnd in self.active_rounds:
+                rnd.rules = self.rules
+        if 'resolver' not in state:
+            self.index_rounds()
+        if 'history' not in state:
+            self.history = History()
 
     def add(self, score, author):
-        "Add a bet to this game"
+        "Add a bet to this game from a score string or parsed score, returning the bet"
 
         # Only add a bet if there are active rounds
         if not self.active_rounds:
             raise GameError('No active rounds to add a bet to!')
 
-        self.attempt('add', score, author)
+        rnd, parsed = self.route(score)
+        goals = rnd.add(parsed, author)
 
         # Add any new players to the scoreboard
-        if author not in self.score_dict:
-            self.score_dict[author] = 0
+        if author not in self.scoreboard:
+            self.scoreboard.set(author, 0)
 
-        return score
+        self.record('add', score, author)
 
-    def attempt(self, action, *args):
-        "Attempt an action on all currently active rounds"
+        return Score(rnd.match, goals + (rnd.match.teams[0],))
 
-        # Make sure tie scores are specified when there are multiple rounds
-        if len(self.active_rounds) > 1 and re.match(r'^\s*\d\s*-\s*\d\s*$', args[0]):
-            raise GameError('There are multiple active rounds - please specify a team with your score.')
+    def route(self, score):
+        "Parse a score if necessary and find the active round it applies to"
+        parsed = Score.parse(score) if isinstance(score, str) else tuple(score)
+        team = parsed[2]
 
+        # Make sure tie scores are specified when there are multiple rounds
+        if not team:
+            if len(self.active_rounds) > 1:
+                raise GameError('There are multiple active rounds - please specify a team with your score.')
+            return next(iter(self.active_rounds)), parsed
+
+        rnd = self.find_round(team)
+        if not rnd:
+            raise ValueError("Your score is not valid for any of the active rounds.")
+        return rnd, parsed
+
+    def find_round(self, team):
+        "Find active round for a (partial) team name or alias"
+        return self.teams.get(self.resolver.resolve(team))
+
+    def index_round(self, rnd):
+        for team in rnd.match.teams:
+            self.teams[team] = rnd
+            self.resolver.add(team, *rnd.match.resolver.aliases.get(team, ()))
+
+    def index_rounds(self):
+        "Rebuild team lookup from scratch"
+        self.teams = {}
+        self.resolver = TeamResolver()
         for rnd in self.active_rounds:
-            try:
-                getattr(rnd, action)(*args)
-            except ValueError:
-                pass
-            else:
-                return rnd
-        raise ValueError("Your score is not valid for any of the active rounds.")
+            self.index_round(rnd)
 
     def close_round(self, final_score):
         "Close round with a final score"
@@ -56,39 +124,87 @@ class Game:
         if not self.active_rounds:
             raise GameError('No active rounds to close!')
 
-        rnd = self.attempt('close', final_score)
+        rnd, parsed = self.route(final_score)
+        rnd.close(parsed)
         self.active_rounds.remove(rnd)
+        self.index_rounds()
+        self.history.record(rnd)
 
         # Add points to scoreboard
         for winner, points in rnd.winners.items():
-            self.score_dict[winner] = self.score_dict.get(winner, 0) + points
+            self.scoreboard.add(winner, points)
+
+        self.record('close_round', final_score)
 
         return rnd.match, final_score, rnd.winners
 
     def new_round(self, match):
         "Start a new round in this game"
-        rnd = Round(match)
+        rnd = Round(match, self.rules)
         if rnd in self.active_rounds:
             raise GameError('Match is already active!')
-        self.active_rounds.add(Round(match))
+        self.active_rounds.add(rnd)
+        self.index_round(rnd)
+        self.record('new_round', match.teams, match.uuid, {team: sorted(match.resolver.aliases[team]) for team in match.teams})
+
+    def record(self, action, *args):
+        "Write a change to the journal, if there is one"
+        if self.journal:
+            self.journal.record(action, *args)
+
+    @property
+    def score_dict(self):
+        return dict(self.scoreboard.points)
 
     @property
     def scores(self):
-        return sorted(self.score_dict.items(), key=operator.itemgetter(1), reverse=True)
+        return list(self.scoreboard)
 
 
-class Round:
+class Round(Slotted):
     """
     A round consists of a match being bet on
     and several scores entered by betters.
+
+    Bets are stored in columns: each author gets a slot,
+    with predicted goals for both teams in byte arrays.
+    Counts per predicted scoreline and outcome are kept up to date as bets come in.
     """
+    __slots__ = ('open', 'match', 'rules', 'authors', 'slots', 'home', 'away', 'histogram', 'outcomes', 'winners', 'version')
 
-    def __init__(self, match):
+    def __init__(self, match, rules=None):
         self.open = True
+        # Number of changes, so copies can tell whether they are still current
+        self.version = 0
         self.match = match
-        self.scores = {}
+        self.rules = rules if rules else RuleSet.default()
+        self.authors = []
+        self.slots = {}
+        self.home = array('B')
+        self.away = array('B')
+        self.histogram = Counter()
+        # Number of bets on a home win, draw and away win
+        self.outcomes = [0, 0, 0]
         self.winners = {}
 
+    def __setstate__(self, state):
+        "Restore round, moving bets of rounds saved with Score objects into columns"
+        scores = state.pop('scores', None)
+        super().__setstate__(state)
+        if 'rules' not in state:
+            self.rules = RuleSet.default()
+        if 'version' not in state:
+            self.version = 0
+        if scores is not None:
+            self.authors, self.slots, self.home, self.away = [], {}, array('B'), array('B')
+        if 'histogram' not in state:
+            self.histogram, self.outcomes = Counter(), [0, 0, 0]
+            for home, away in zip(self.home, self.away):
+                self.count(home, away, 1)
+        if scores is not None:
+            for author, score in scores.items():
+                self.store(author, *(score[team] for team in self.match.teams))
+
     def __hash__(self):
         return hash(tuple(set(self.match.teams)))
 
@@ -99,62 +215,143 @@ class Round:
     def __str__(self):
         return str(self.match)
 
+    def copy(self):
+        "Copy of this round's bets and results, sharing the match"
+        rnd = Round.__new__(Round)
+        rnd.open, rnd.match, rnd.rules = self.open, self.match, self.rules
+        rnd.authors, rnd.slots = self.authors.copy(), self.slots.copy()
+        rnd.home, rnd.away = array('B', self.home), array('B', self.away)
+        rnd.histogram, rnd.outcomes = self.histogram.copy(), self.outcomes.copy()
+        rnd.winners = self.winners.copy()
+        rnd.version = self.version
+        return rnd
+
+    @property
+    def scores(self):
+        "Bets as Score objects, by author"
+        return {author: Score(self.match, (home, away, self.match.teams[0]), author) for author, home, away in zip(self.authors, self.home, self.away)}
+
+    def bet(self, author):
+        "Get the bet of an author as a Score, if any"
+        slot = self.slots.get(author)
+        if slot is not None:
+            return Score(self.match, (self.home[slot], self.away[slot], self.match.teams[0]), author)
+
+    @property
+    def popular(self):
+        "Predicted scores as Score objects with their number of bets, most popular first"
+        return [(Score(self.match, divmod(line, GOALS) + (self.match.teams[0],)), count) for line, count in self.histogram.most_common()]
+
     def add(self, score, author):
         "Add a bet to this round"
         if not self.open:
             raise GameError("This round is closed!")
-        self.scores[author] = Score(self.match, score, author)
+        goals = Score.orient(self.match, score)
+        self.store(author, *goals)
+        return goals
+
+    def store(self, author, home, away):
+        "Store a bet, replacing any previous bet by the same author"
+        self.version += 1
+        slot = self.slots.get(author)
+        if slot is None:
+            self.slots[author] = len(self.authors)
+            # Share author strings between rounds (test backends have no names)
+            self.authors.append(sys.intern(author) if isinstance(author, str) else author)
+            self.home.append(home)
+            self.away.append(away)
+        else:
+            self.count(self.home[slot], self.away[slot], -1)
+            self.home[slot] = home
+            self.away[slot] = away
+        self.count(home, away, 1)
+
+    def count(self, home, away, change):
+        "Update scoreline and outcome counts"
+        line = scoreline(home, away)
+        self.histogram[line] += change
+        if not self.histogram[line]:
+            del self.histogram[line]
+        self.outcomes[1 - sign(home - away)] += change
 
     def close(self, final_score):
-        "Close round and determine winner"
+        "Close round and determine winners"
         self.match.score = final_score = Score(self.match, final_score)
-        # Determine differences between bets and final score
-        deltas = sorted([(score.author, final_score - score) for score in self.scores.values()], key=operator.itemgetter(1))
-        # Calculate scores -- 2 if exact, otherwise 1 for being closest
-        for delta in deltas:
-            if delta[1] == deltas[0][1]:
-                self.winners[delta[0]] = EXACT_GUESS_POINTS if delta[1] == 0 else CLOSEST_GUESS_POINTS
+        points = self.rules.points(self.home, self.away, final_score.scoreline)
+        self.winners = {author: award for author, award in zip(self.authors, points) if award}
         self.open = False
+        self.version += 1
 
 
-class Match:
+class Match(Slotted):
     """
     A match is a sports game between two teams.
     """
+    __slots__ = ('teams', 'score', 'uuid', 'resolver', 'team_cache')
 
-    def __init__(self, teams, uuid=None):
+    def __init__(self, teams, uuid=None, resolver=None):
         if len(teams) != 2:
             raise Exception("A match must have two teams!")
         self.teams = teams
         self.score = None
         self.uuid = uuid
+        # Competition-wide resolver if available, so abbreviations and aliases work
+        self.resolver = resolver if resolver else TeamResolver.for_teams(teams)
+        for team in teams:
+            if team not in self.resolver:
+                self.resolver.add(team)
+        self.team_cache = {}
+
+    def __getstate__(self):
+        "Save only the aliases of this match's teams, not a competition-wide resolver"
+        state = super().__getstate__()
+        del state['team_cache']
+        resolver = state.pop('resolver')
+        state['aliases'] = {team: sorted(resolver.aliases.get(team, ())) for team in self.teams}
+        return state
+
+    def __setstate__(self, state):
+        "Restore match, rebuilding its team resolver from the saved aliases"
+        aliases = state.pop('aliases', None)
+        resolver = state.pop('resolver', None)
+        super().__setstate__(state)
+        if aliases is None and resolver is not None:
+            # Saved with a whole resolver, possibly shared by a competition
+            aliases = {team: sorted(resolver.aliases.get(team, ())) for team in self.teams}
+        self.resolver = TeamResolver(aliases) if aliases is not None else TeamResolver.for_teams(self.teams)
+        self.team_cache = {}
 
     def __str__(self):
         return ' vs. '.join(self.teams)
 
     def get_team(self, name):
         "Loose match string to teams"
-        for team in self.teams:
-            if name.lower() in team.lower():
-                return team
+        if name not in self.team_cache:
+            self.team_cache[name] = self.resolver.resolve(name, among=self.teams)
+        return self.team_cache[name]
 
 
-class Score:
+class Score(Slotted):
     """
     Outcome of a match.
     """
+    __slots__ = ('match', 'author', 'score', 'winner')
     regex = re.compile(r'\s*(\d)\s*-\s*(\d)\s*(?!:for)?\s*(.+)?')
 
     def __init__(self, match, score, author=None):
         self.match = match
         self.author = author
 
-        # Parse score string
-        score_elements = self.regex.match(score)
-        if not score_elements:
-            raise ValueError("That doesn't seem to be a valid score!")
-        score_a, score_b, team_a = score_elements.groups()
-        scores = [int(score_a), int(score_b)]
+        # Save score as a dict and cache predicted winning team
+        self.score = dict(zip(match.teams, self.orient(match, score)))
+        self.winner = None if len(set(self.score.values())) == 1 else sorted(self.score.items(), key=operator.itemgetter(1))[1][0]
+
+    @classmethod
+    def orient(cls, match, score):
+        "Get goals for both teams in match order from a score string or parsed score"
+        # Parse score string, unless that already happened
+        score_a, score_b, team_a = cls.parse(score) if isinstance(score, str) else score
+        scores = (score_a, score_b)
 
         # Check team name, if given
         if team_a and not match.get_team(team_a):
@@ -166,15 +363,26 @@ class Score:
                 raise ValueError("If score is not a tie, specify a team for ordering!")
             # Reverse scores depending on the order of the teams in the match
             if match.teams[0] != match.get_team(team_a):
-                scores.reverse()
-
-        # Save score as a dict and cache predicted winning team
-        self.score = dict(zip(match.teams, scores))
-        self.winner = None if score_a == score_b else sorted(self.score.items(), key=operator.itemgetter(1))[1][0]
+                scores = (score_b, score_a)
+        return scores
 
     def __getitem__(self, key):
         return self.score[key]
 
+    @property
+    def scoreline(self):
+        "Index of this score in rule tables"
+        return scoreline(*(self.score[team] for team in self.match.teams))
+
+    @classmethod
+    def parse(cls, score):
+        "Split a score string into both goal counts and an optional team name"
+        score_elements = cls.regex.match(score)
+        if not score_elements:
+            raise ValueError("That doesn't seem to be a valid score!")
+        score_a, score_b, team_a = score_elements.groups()
+        return int(score_a), int(score_b), team_a
+
     def __repr__(self):
         return '<Score {}>'.format(str(self))
 
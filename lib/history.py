@@ -0,0 +1,148 @@
+from array import array
+
+from lib.rules import sign
+from lib.settings import STATS_MIN_BETS
+
+
+class PlayerHistory:
+    """
+    Running totals of every closed bet of one player.
+
+    Totals are updated once per closed round, so questions about a player
+    are answered without going back over old rounds. Only the goal error
+    per round is kept, to compare players head to head.
+    """
+    __slots__ = ('bets', 'points', 'exact', 'outcomes', 'error', 'streak', 'best_streak', 'rounds', 'errors')
+
+    def __init__(self):
+        self.bets = 0
+        self.points = 0
+        # Bets with the exact score, and with the right winner or draw
+        self.exact = 0
+        self.outcomes = 0
+        # Sum of goals every bet was off by
+        self.error = 0
+        # Bets in a row that earned points
+        self.streak = 0
+        self.best_streak = 0
+        # Sequence numbers of rounds bet on, and the goals that bet was off by
+        self.rounds = array('L')
+        self.errors = array('B')
+
+    def copy(self):
+        other = PlayerHistory.__new__(PlayerHistory)
+        for slot in self.__slots__:
+            setattr(other, slot, getattr(self, slot))
+        other.rounds = array('L', self.rounds)
+        other.errors = array('B', self.errors)
+        return other
+
+    def add(self, number, error, outcome, points):
+        "Count a closed bet"
+        self.bets += 1
+        self.points += points
+        self.exact += not error
+        self.outcomes += outcome
+        self.error += error
+        self.streak = self.streak + 1 if points else 0
+        self.best_streak = max(self.best_streak, self.streak)
+        self.rounds.append(number)
+        self.errors.append(min(error, 255))
+
+    @property
+    def exact_rate(self):
+        return self.exact / self.bets if self.bets else 0
+
+    @property
+    def outcome_rate(self):
+        return self.outcomes / self.bets if self.bets else 0
+
+    @property
+    def average_error(self):
+        return self.error / self.bets if self.bets else 0
+
+
+class History:
+    """
+    Statistics of every player over all closed rounds,
+    kept across game restarts and tournaments.
+    """
+    # Statistics players can be ranked by, and whether lower is better
+    METRICS = {
+        'points': False,
+        'bets': False,
+        'exact': False,
+        'exact_rate': False,
+        'outcome_rate': False,
+        'average_error': True,
+        'best_streak': False,
+    }
+    # Statistics that mean little for players with only a few bets
+    RATES = ('exact_rate', 'outcome_rate', 'average_error')
+
+    def __init__(self):
+        self.players = {}
+        # Closed rounds so far, numbering rounds for head to head comparisons
+        self.rounds = 0
+        self._leaderboards = {}
+
+    def __contains__(self, player):
+        return player in self.players
+
+    def __getitem__(self, player):
+        return self.players[player]
+
+    def __getstate__(self):
+        return {'players': self.players, 'rounds': self.rounds}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._leaderboards = {}
+
+    def copy(self):
+        "Independent copy, for readers while the original keeps changing"
+        other = History()
+        other.players = {player: stats.copy() for player, stats in self.players.items()}
+        other.rounds = self.rounds
+        return other
+
+    def record(self, rnd):
+        "Add the bets of a closed round"
+        self.rounds += 1
+        self._leaderboards = {}
+        final = rnd.match.score
+        home, away = (final[team] for team in rnd.match.teams)
+        outcome = sign(home - away)
+        for author, bet_home, bet_away in zip(rnd.authors, rnd.home, rnd.away):
+            stats = self.players.get(author)
+            if stats is None:
+                stats = self.players[author] = PlayerHistory()
+            stats.add(self.rounds, abs(bet_home - home) + abs(bet_away - away), sign(bet_home - bet_away) == outcome, rnd.winners.get(author, 0))
+
+    def leaderboard(self, metric, count=10):
+        "Get (player, value) tuples of the players with the best value of a statistic"
+        if metric not in self._leaderboards:
+            minimum = STATS_MIN_BETS if metric in self.RATES else 1
+            values = [(getattr(stats, metric), str(player), player) for player, stats in self.players.items() if stats.bets >= minimum]
+            values.sort(key=lambda entry: (entry[0] if self.METRICS[metric] else -entry[0], entry[1]))
+            self._leaderboards[metric] = [(player, value) for value, _, player in values]
+        return self._leaderboards[metric][:count]
+
+    def head_to_head(self, player, rival):
+        "Count rounds both bet on where the player was closer, the rival was closer, or they were even"
+        mine, theirs = self.players[player], self.players[rival]
+        closer = further = even = 0
+        i = j = 0
+        while i < len(mine.rounds) and j < len(theirs.rounds):
+            if mine.rounds[i] < theirs.rounds[j]:
+                i += 1
+            elif mine.rounds[i] > theirs.rounds[j]:
+                j += 1
+            else:
+                difference = mine.errors[i] - theirs.errors[j]
+                closer += difference < 0
+                further += difference > 0
+                even += not difference
+                i += 1
+                j += 1
+        return closer, further, even
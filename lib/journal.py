@@ -0,0 +1,121 @@
+import json
+import os
+import pickle
+import threading
+from time import time
+
+from lib.game import Game, Match
+from lib.settings import JOURNAL_SNAPSHOT_EVERY, JOURNAL_SYNC_EVERY, JOURNAL_SYNC_INTERVAL
+from lib.teams import TeamResolver
+
+
+class Journal:
+    """
+    Append-only log of changes to a game, with periodic snapshots.
+
+    Every change is written out right away and fsynced in batches.
+    Restoring loads the latest snapshot and replays only the
+    changes made after it.
+    """
+
+    def __init__(self, directory, sync_every=JOURNAL_SYNC_EVERY, sync_interval=JOURNAL_SYNC_INTERVAL, snapshot_every=JOURNAL_SNAPSHOT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, 'snapshot.pickle')
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.game = None
+        # Sequence number of the last recorded change
+        self.sequence = 0
+        self.since_snapshot = 0
+        self.unsynced = 0
+        self.synced = time()
+        self.file = None
+        self._lock = threading.RLock()
+
+    @property
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path)
+
+    def attach(self, game):
+        "Start journaling changes to a game, taking a snapshot of its current state"
+        with self._lock:
+            if self.game:
+                self.game.journal = None
+            self.game = game
+            game.journal = self
+            self.snapshot()
+
+    def restore(self):
+        "Load latest snapshot and replay the journal on top of it"
+        game, self.sequence = Game(), 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                game, self.sequence = pickle.load(snapshot)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        sequence, action, *args = json.loads(line)
+                    except ValueError:
+                        # Partly written last line of a crash
+                        break
+                    # Changes might still be in the journal if we crashed while snapshotting
+                    if sequence <= self.sequence:
+                        continue
+                    self.replay(game, action, args)
+                    self.sequence = sequence
+        return game
+
+    @staticmethod
+    def replay(game, action, args):
+        if action == 'new_round':
+            teams, uuid, aliases = args
+            game.new_round(Match(teams, uuid, TeamResolver(aliases)))
+        else:
+            getattr(game, action)(*args)
+
+    def record(self, action, *args):
+        "Write a change to the journal"
+        with self._lock:
+            self.sequence += 1
+            self.file.write(json.dumps([self.sequence, action, *args]) + '\n')
+            # Flush so the change survives the process dying, fsync later for the OS dying
+            self.file.flush()
+            self.unsynced += 1
+            self.since_snapshot += 1
+            if self.since_snapshot >= self.snapshot_every:
+                self.snapshot()
+            elif self.unsynced >= self.sync_every or time() - self.synced > self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        "Make sure all recorded changes are on disk"
+        with self._lock:
+            if self.file and self.unsynced:
+                os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.synced = time()
+
+    def snapshot(self):
+        "Save the full game and start an empty journal"
+        with self._lock:
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'wb') as snapshot:
+                pickle.dump((self.game, self.sequence), snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            if self.file:
+                self.file.close()
+            self.file = open(self.journal_path, 'w')
+            self.since_snapshot = 0
+            self.unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self.file:
+                self.sync()
+                self.file.close()
+                self.file = None
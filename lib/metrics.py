@@ -0,0 +1,185 @@
+import functools
+import inspect
+import os
+import threading
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper bounds of latency buckets in seconds, doubling from 100us to about a minute
+BUCKETS = tuple(0.0001 * 2 ** exponent for exponent in range(20))
+
+
+class Histogram:
+    """
+    Latency distribution in fixed buckets.
+
+    Memory stays the same however many values are observed,
+    at the cost of quantiles only being as precise as the buckets.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        # The last bucket catches everything above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, fraction):
+        "Upper bound of the bucket holding the given fraction of values"
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        return self.bounds[min(bucket, len(self.bounds) - 1)]
+
+
+class Metrics:
+    """
+    Registry of runtime measurements: latency histograms, counters,
+    and gauges that are read when the metrics are shown.
+
+    Every measurement has a name and optional labels, like in Prometheus.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def histogram(self, name, **labels):
+        key = self.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        "Add a value in seconds to a histogram"
+        self.histogram(name, **labels).observe(value)
+
+    def count(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self.key(name, labels)] += value
+
+    def gauge(self, name, read, **labels):
+        "Register a function that returns the current value of something"
+        self.gauges[self.key(name, labels)] = read
+
+    @contextmanager
+    def timer(self, name, **labels):
+        "Time a block of code into a histogram"
+        histogram = self.histogram(name, **labels)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(perf_counter() - start)
+
+    def timed(self, name, by=None, **labels):
+        """
+        Decorator timing every call of a function into a histogram,
+        labelled with the function name as `by` if given.
+
+        Generator functions are timed until they are exhausted.
+        """
+        def decorator(function):
+            extra = {by: function.__name__} if by else {}
+            histogram = self.histogram(name, **labels, **extra)
+            if inspect.isgeneratorfunction(function):
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    start = perf_counter()
+                    try:
+                        return (yield from function(*args, **kwargs))
+                    finally:
+                        histogram.observe(perf_counter() - start)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    start = perf_counter()
+                    try:
+                        return function(*args, **kwargs)
+                    finally:
+                        histogram.observe(perf_counter() - start)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def name(key):
+        name, labels = key
+        if not labels:
+            return name
+        return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(*label) for label in labels))
+
+    def summary(self):
+        "Human readable overview of all measurements"
+        lines = []
+        for key, histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                lines.append('{}: {} calls, avg {:.1f}ms, p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms'.format(
+                    self.name(key), histogram.count, histogram.sum / histogram.count * 1000,
+                    *(histogram.quantile(fraction) * 1000 for fraction in (0.5, 0.95, 0.99)),
+                ))
+        for key, value in sorted(self.counters.items()):
+            lines.append('{}: {}'.format(self.name(key), value))
+        for key, read in sorted(self.gauges.items()):
+            lines.append('{}: {}'.format(self.name(key), read()))
+        return '\n'.join(lines) or 'Nothing measured yet.'
+
+    def prometheus(self):
+        "All measurements in the Prometheus text exposition format"
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{} {}'.format(self.name((name + '_bucket', labels + (('le', le),))), cumulative))
+            lines.append('{} {}'.format(self.name((name + '_sum', labels)), histogram.sum))
+            lines.append('{} {}'.format(self.name((name + '_count', labels)), histogram.count))
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append('{} {}'.format(self.name((name, labels)), value))
+        for (name, labels), read in sorted(self.gauges.items()):
+            declare(name, 'gauge')
+            lines.append('{} {}'.format(self.name((name, labels)), read()))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        "Atomically write all measurements for a Prometheus textfile collector"
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as metrics_file:
+            metrics_file.write(self.prometheus())
+        os.replace(temporary, path)
+
+
+# Measurements of this process
+metrics = Metrics()
@@ -0,0 +1,83 @@
+import threading
+from time import monotonic
+
+from lib.ratelimit import TokenBucket
+from lib.settings import ACK_DIGEST_WINDOW, OUTBOX_BURST, OUTBOX_RATE
+
+
+class Room:
+    __slots__ = ('target', 'bucket', 'posts', 'acks', 'reply_to', 'since')
+
+    def __init__(self, target, bucket):
+        self.target = target
+        self.bucket = bucket
+        self.posts = []
+        self.acks = []
+        # Message everything queued is in reply to, if it's all the same one
+        self.reply_to = None
+        self.since = None
+
+
+class Outbox:
+    """
+    Outgoing messages, rate limited per room.
+
+    Posts go out right away while a room has tokens left in its bucket,
+    otherwise they wait and get merged into a single post.
+    Bet acknowledgements always wait a short window and go out as one digest.
+    """
+
+    def __init__(self, send, window=ACK_DIGEST_WINDOW, burst=OUTBOX_BURST, rate=OUTBOX_RATE):
+        self.send = send
+        self.window = window
+        self.burst = burst
+        self.rate = rate
+        self.rooms = {}
+        self._lock = threading.Lock()
+
+    def room(self, target):
+        key = str(target)
+        if key not in self.rooms:
+            self.rooms[key] = Room(target, TokenBucket(self.burst, self.rate))
+        return self.rooms[key]
+
+    def post(self, target, text, in_reply_to=None):
+        "Send a message, or queue it if the room is over its rate limit"
+        with self._lock:
+            room = self.room(target)
+            immediate = not room.posts and room.bucket.take()
+            if not immediate:
+                self.queue(room, room.posts, text, in_reply_to)
+        if immediate:
+            self.send(target, text, in_reply_to)
+
+    def acknowledge(self, target, text, in_reply_to=None):
+        "Queue a bet acknowledgement for the next digest"
+        with self._lock:
+            room = self.room(target)
+            self.queue(room, room.acks, text, in_reply_to)
+
+    def flush(self, now=None):
+        "Send queued messages for every room whose window has passed and that has tokens left"
+        now = monotonic() if now is None else now
+        outgoing = []
+        with self._lock:
+            for room in self.rooms.values():
+                if room.since is None or now - room.since < self.window or not room.bucket.take():
+                    continue
+                lines = room.posts
+                if room.acks:
+                    lines.append('Noted: {}'.format(', '.join(room.acks)))
+                outgoing.append((room.target, '\n'.join(lines), room.reply_to))
+                room.posts, room.acks, room.reply_to, room.since = [], [], None, None
+        for target, text, reply_to in outgoing:
+            self.send(target, text, reply_to)
+        return len(outgoing)
+
+    def queue(self, room, entries, text, in_reply_to):
+        entries.append(text)
+        if room.since is None:
+            room.since = monotonic()
+            room.reply_to = in_reply_to
+        elif room.reply_to is not in_reply_to:
+            room.reply_to = None
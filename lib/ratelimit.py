@@ -0,0 +1,41 @@
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing bursts of up to `capacity` actions,
+    refilled at `rate` tokens per second.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, tokens=1):
+        "Take tokens if available, returning whether that succeeded"
+        with self._lock:
+            self._fill()
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def wait(self, tokens=1):
+        "Block until tokens can be taken, then take them"
+        while not self.take(tokens):
+            sleep(self.delay(tokens))
+
+    def delay(self, tokens=1):
+        "Seconds until the given amount of tokens will be available"
+        with self._lock:
+            self._fill()
+            return max(0, (tokens - self.tokens) / self.rate)
+
+    def _fill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
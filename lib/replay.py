@@ -0,0 +1,176 @@
+"""
+Replay recorded tournaments through the game to compare rules offline
+
+Run from the repository root:
+
+    python -m lib.replay chat.jsonl matches.json --vary exact=2,3 --vary betting_time=3600,7200
+
+The chat log has one JSON message per line, ordered by time, with `time`
+(ISO 8601 or seconds since the epoch), `author` and `body`. Match results
+are a football-data.org matches payload. Every combination of --vary values
+is played in a process pool and prints its final leaderboard.
+
+Every replay streams the chat log from disk again, so logs never have to
+fit in memory. Only the match results are loaded once per worker.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from operator import itemgetter
+from time import perf_counter
+
+from lib.api import MatchIndex
+from lib.dispatch import Dispatcher
+from lib.game import Game, GameError, Match
+from lib.rules import RuleSet
+from lib.settings import MATCH_DURATION, PRE_MATCH_BETTING_TIME
+
+# Kinds of events, in the order they happen at the same instant:
+# finished rounds close before new ones open, and bets come after both
+CLOSE, OPEN, MESSAGE = range(3)
+
+# Parameters a variant can change
+DEFAULTS = dict(
+    {rule: getattr(RuleSet.default(), rule) for rule in RuleSet.RULES},
+    betting_time=PRE_MATCH_BETTING_TIME,
+    match_duration=MATCH_DURATION,
+)
+
+# Chat log path and match results, loaded once per worker process
+tournament = None
+
+
+def timestamp(value):
+    "Seconds since the epoch from a number or an ISO 8601 string"
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+def read_chat(path):
+    "Yield (time, MESSAGE, (author, body)) events from a chat log"
+    with open(path) as log:
+        for line in log:
+            if line.strip():
+                message = json.loads(line)
+                yield timestamp(message['time']), MESSAGE, (message['author'], message['body'])
+
+
+def read_matches(path):
+    "Load matches from a football-data.org payload or a plain list of matches"
+    with open(path) as results:
+        data = json.load(results)
+    return data['matches'] if isinstance(data, dict) else data
+
+
+def schedule(matches, betting_time=PRE_MATCH_BETTING_TIME, match_duration=MATCH_DURATION):
+    "Yield (time, OPEN/CLOSE, match) events for matches, ordered by time"
+    index = MatchIndex(matches)
+    opened = ((kickoff - betting_time, OPEN, (match, index.teams)) for kickoff, match in zip(index.kickoffs, index.matches))
+    # Like the bot, only close rounds of matches with a final score
+    closed = ((kickoff + match_duration, CLOSE, match) for kickoff, match in zip(index.kickoffs, index.matches) if match.get('status') == 'FINISHED')
+    return heapq.merge(opened, closed, key=itemgetter(0, 1))
+
+
+def timeline(chat, matches, betting_time=PRE_MATCH_BETTING_TIME, match_duration=MATCH_DURATION):
+    "Merge chat events with the schedule of matches into one stream ordered by time"
+    return heapq.merge(chat, schedule(matches, betting_time, match_duration), key=itemgetter(0, 1))
+
+
+def parse(body):
+    "Parse a bet from a chat message the way the bot would, or None"
+    if body.startswith('!score '):
+        body = body[7:].strip()
+    return Dispatcher.parse_score(body)
+
+
+def play(events, rules=None):
+    "Run a stream of events through a new game and return the game"
+    game = Game(rules=rules)
+    for _, kind, payload in events:
+        if kind == MESSAGE:
+            author, body = payload
+            score = parse(body)
+            if score is None:
+                continue
+            try:
+                game.add(score, author)
+            except (GameError, ValueError):
+                pass
+        elif kind == OPEN:
+            match, teams = payload
+            try:
+                game.new_round(Match([match['homeTeam']['name'], match['awayTeam']['name']], match['id'], teams))
+            except GameError:
+                pass
+        else:
+            full_time = payload['score']['fullTime']
+            try:
+                game.close_round('{}-{} {}'.format(full_time['home'], full_time['away'], payload['homeTeam']['name']))
+            except (GameError, ValueError):
+                pass
+    return game
+
+
+def load(chat_path, results_path):
+    "Read the match results of a recorded tournament into this process"
+    global tournament
+    tournament = chat_path, read_matches(results_path)
+
+
+def backtest(variant, top=10):
+    "Replay the loaded tournament with some parameters changed, returning the variant and its leaderboard"
+    params = dict(DEFAULTS, **variant)
+    rules = RuleSet(**{rule: params[rule] for rule in RuleSet.RULES})
+    chat_path, matches = tournament
+    game = play(timeline(read_chat(chat_path), matches, params['betting_time'], params['match_duration']), rules)
+    return variant, game.scoreboard.top(top)
+
+
+def variants(vary):
+    "Every combination of values from 'name=value,value' strings, as dicts"
+    options = []
+    for option in vary:
+        name, _, values = option.partition('=')
+        if name not in DEFAULTS:
+            raise ValueError('Unknown parameter {}, pick from {}'.format(name, ', '.join(DEFAULTS)))
+        options.append([(name, int(value)) for value in values.split(',')])
+    return [dict(combination) for combination in itertools.product(*options)]
+
+
+def run(chat_path, results_path, variants=({},), workers=None, top=10):
+    "Backtest every variant, in parallel unless workers is 1"
+    if workers == 1:
+        load(chat_path, results_path)
+        return [backtest(variant, top) for variant in variants]
+    # Fork from a clean server process, the caller may be running threads
+    context = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(workers, context, initializer=load, initargs=(chat_path, results_path)) as pool:
+        return list(pool.map(backtest, variants, itertools.repeat(top)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded tournament with different rules')
+    parser.add_argument('chat', help='JSON lines chat log')
+    parser.add_argument('results', help='football-data.org matches payload')
+    parser.add_argument('--vary', action='append', default=[], metavar='NAME=VALUES', help='comma separated values to try for one of: {}'.format(', '.join(DEFAULTS)))
+    parser.add_argument('--workers', type=int, help='processes to replay on (default: one per CPU)')
+    parser.add_argument('--top', type=int, default=10, help='leaderboard places to show')
+    options = parser.parse_args(args)
+    try:
+        tried = variants(options.vary)
+    except ValueError as error:
+        parser.error(str(error))
+    start = perf_counter()
+    for variant, leaderboard in run(options.chat, options.results, tried, options.workers, options.top):
+        name = ' '.join('{}={}'.format(*param) for param in variant.items()) or 'defaults'
+        print('{}: {}'.format(name, ' / '.join('{}:{}'.format(*score) for score in leaderboard) or 'no points'))
+    print('Replayed {} variant{} in {:.2f}s'.format(len(tried), '' if len(tried) == 1 else 's', perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+from array import array
+from functools import lru_cache
+
+from lib.settings import SCORING_RULES
+
+# NumPy is optional and slow to import, so it is only imported once a round
+# has enough bets to need it. Ellipsis means it has not been looked for yet.
+numpy = ...
+
+# Scores only have single digit goals, so there are 100 possible scorelines
+GOALS = 10
+SCORELINES = GOALS * GOALS
+
+# Below this many bets, plain Python beats NumPy's overhead
+VECTORIZE_MIN = 64
+
+
+def scoreline(home, away):
+    "Index of a scoreline in payoff tables"
+    return home * GOALS + away
+
+
+def sign(number):
+    return (number > 0) - (number < 0)
+
+
+def load_numpy():
+    "Import NumPy on first use, returning None if it is not installed"
+    global numpy
+    if numpy is ...:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+class RuleSet:
+    """
+    Points awarded for predictions.
+
+    Rules for the prediction alone (exact score, outcome, goal difference)
+    are compiled into a payoff table, and goal distances for the closest
+    guess rule into a distance table, so scoring a bet is a table lookup.
+    An exact guess earns the exact points only, the closest guess
+    points go to the nearest bets if nobody guessed exactly.
+    """
+
+    RULES = ('exact', 'closest', 'outcome', 'goal_difference')
+
+    def __init__(self, exact=0, closest=0, outcome=0, goal_difference=0):
+        self.exact = exact
+        self.closest = closest
+        self.outcome = outcome
+        self.goal_difference = goal_difference
+        self.payoffs, self.distances = self.compile(exact, outcome, goal_difference)
+
+    def __reduce__(self):
+        # Tables are rebuilt rather than pickled
+        return self.__class__, tuple(getattr(self, rule) for rule in self.RULES)
+
+    def __eq__(self, other):
+        return isinstance(other, RuleSet) and self.__reduce__() == other.__reduce__()
+
+    def __hash__(self):
+        return hash(self.__reduce__()[1])
+
+    def __repr__(self):
+        return '<RuleSet {}>'.format(', '.join('{}={}'.format(rule, getattr(self, rule)) for rule in self.RULES))
+
+    @classmethod
+    def default(cls):
+        return cls(**SCORING_RULES)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def compile(exact, outcome, goal_difference):
+        "Build payoff and distance tables, indexed by result * SCORELINES + prediction"
+        payoffs = array('h', bytes(2 * SCORELINES * SCORELINES))
+        distances = array('b', bytes(SCORELINES * SCORELINES))
+        for result in range(SCORELINES):
+            res_home, res_away = divmod(result, GOALS)
+            for prediction in range(SCORELINES):
+                home, away = divmod(prediction, GOALS)
+                offset = result * SCORELINES + prediction
+                distances[offset] = abs(home - res_home) + abs(away - res_away)
+                if prediction == result:
+                    payoffs[offset] = exact
+                    continue
+                if sign(home - away) == sign(res_home - res_away):
+                    payoffs[offset] += outcome
+                if home - away == res_home - res_away:
+                    payoffs[offset] += goal_difference
+        return payoffs, distances
+
+    def award(self, predictions, result):
+        "Calculate points for a dictionary of predicted scorelines, leaving out bets without points"
+        home = array('B', (prediction // GOALS for prediction in predictions.values()))
+        away = array('B', (prediction % GOALS for prediction in predictions.values()))
+        return {key: points for key, points in zip(predictions, self.points(home, away, result)) if points}
+
+    def points(self, home, away, result):
+        "Calculate points for arrays of predicted goals"
+        row = result * SCORELINES
+        if len(home) >= VECTORIZE_MIN and load_numpy() is not None:
+            predictions = numpy.frombuffer(home, dtype=numpy.uint8).astype(numpy.intp) * GOALS + numpy.frombuffer(away, dtype=numpy.uint8)
+            payoffs = numpy.frombuffer(self.payoffs, dtype=numpy.int16)[row:row + SCORELINES][predictions]
+            distances = numpy.frombuffer(self.distances, dtype=numpy.int8)[row:row + SCORELINES][predictions]
+            closest = distances.min()
+            if closest:
+                payoffs = payoffs + (distances == closest) * self.closest
+            return payoffs.tolist()
+        predictions = [h * GOALS + a for h, a in zip(home, away)]
+        payoffs = self.payoffs[row:row + SCORELINES]
+        distances = [self.distances[row + prediction] for prediction in predictions]
+        closest = min(distances, default=0)
+        return [payoffs[prediction] + (self.closest if closest and distance == closest else 0) for prediction, distance in zip(predictions, distances)]
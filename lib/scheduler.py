@@ -0,0 +1,81 @@
+from datetime import datetime
+from time import time
+
+from lib.ratelimit import TokenBucket
+from lib.settings import API_CALLS_PER_MINUTE, MATCH_DURATION, POLL_MAX_INTERVAL, POLL_MIN_INTERVAL, PRE_MATCH_BETTING_TIME
+
+
+class PollScheduler:
+    """
+    Decides when the match source next needs polling.
+
+    Polls right when betting opens for a match and often once an
+    active match is due to finish, backing off exponentially in between.
+    """
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, calls_per_minute=API_CALLS_PER_MINUTE):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.next_poll = 0
+        # IDs of active matches past their expected final whistle
+        self.overdue = set()
+        self.quota = TokenBucket(calls_per_minute, calls_per_minute / 60)
+
+    def due(self, now=None):
+        "Check whether a poll should run now"
+        now = time() if now is None else now
+        if now < self.next_poll:
+            return False
+        # Never poll faster than the API allows
+        if not self.quota.take():
+            self.next_poll = now + self.quota.delay()
+            return False
+        return True
+
+    def plan(self, index, active_rounds, stale=False, now=None):
+        "Schedule the next poll, returning the delay until it"
+        now = time() if now is None else now
+        instants = []
+
+        # Next match to open for betting
+        opening = index.since(now + PRE_MATCH_BETTING_TIME)
+        if opening:
+            instants.append(self.kickoff(opening[0]) - PRE_MATCH_BETTING_TIME)
+
+        # Expected final whistles of active matches
+        self.overdue = set()
+        for rnd in active_rounds:
+            match = index.get(getattr(rnd.match, 'uuid', None))
+            if not match:
+                continue
+            full_time = self.kickoff(match) + MATCH_DURATION
+            if full_time <= now:
+                self.overdue.add(match['id'])
+            else:
+                instants.append(full_time)
+
+        # Poll quickly around full time or when data is still being refreshed, back off otherwise
+        if self.hot or stale:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        delay = min([self.interval] + [instant - now for instant in instants])
+        self.next_poll = now + max(delay, 0)
+        return delay
+
+    @property
+    def hot(self):
+        "Whether results are due for any active match"
+        return bool(self.overdue)
+
+    def backoff(self, now=None):
+        "Schedule a retry after a failed poll, returning the delay until it"
+        now = time() if now is None else now
+        self.interval = min(self.interval * 2, self.max_interval)
+        self.next_poll = now + self.interval
+        return self.interval
+
+    @staticmethod
+    def kickoff(match):
+        return datetime.fromisoformat(match['utcDate']).timestamp()
@@ -0,0 +1,87 @@
+from bisect import bisect_left, insort
+from collections import Counter
+
+
+class Scoreboard:
+    """
+    Points per player, kept in ranked order.
+
+    Updating a player only moves that player, so reading the
+    ranking or a player's rank never needs a full sort.
+    Ranks are dense: tied players share a rank and the next
+    player down gets the rank right after theirs.
+    """
+    # Number of changes, so copies can tell whether they are still current
+    version = 0
+
+    def __init__(self, points=None):
+        self.points = {}
+        # (-points, name, player) sorted from first to last place
+        self.ranking = []
+        # Distinct point totals, negated and sorted, with number of players on each
+        self.levels = []
+        self.counts = Counter()
+        for player, points in (points or {}).items():
+            self.set(player, points)
+
+    def __contains__(self, player):
+        return player in self.points
+
+    def __iter__(self):
+        return ((player, -points) for points, _, player in self.ranking)
+
+    def __len__(self):
+        return len(self.ranking)
+
+    def copy(self):
+        scoreboard = Scoreboard()
+        scoreboard.points = self.points.copy()
+        scoreboard.ranking = self.ranking.copy()
+        scoreboard.levels = self.levels.copy()
+        scoreboard.counts = self.counts.copy()
+        return scoreboard
+
+    def add(self, player, points):
+        "Add points for a player"
+        self.set(player, self.points.get(player, 0) + points)
+
+    def set(self, player, points):
+        "Set total points for a player"
+        self.version += 1
+        if player in self.points:
+            self.remove(player)
+        self.points[player] = points
+        insort(self.ranking, (-points, str(player), player))
+        if not self.counts[points]:
+            insort(self.levels, -points)
+        self.counts[points] += 1
+
+    def remove(self, player):
+        "Take a player off the scoreboard"
+        self.version += 1
+        points = self.points.pop(player)
+        del self.ranking[bisect_left(self.ranking, (-points, str(player)))]
+        self.counts[points] -= 1
+        if not self.counts[points]:
+            del self.counts[points]
+            del self.levels[bisect_left(self.levels, -points)]
+
+    def rank(self, player):
+        "Dense rank of a player, starting at 1"
+        return bisect_left(self.levels, -self.points[player]) + 1
+
+    def tied(self, player):
+        "Whether other players have the same points as this player"
+        return self.counts[self.points[player]] > 1
+
+    def top(self, count):
+        "Get (player, points) tuples for the first count places"
+        return [(player, -points) for points, _, player in self.ranking[:count]]
+
+    def page(self, number, size):
+        "Get (player, points) tuples for a page of the ranking, starting at 1"
+        start = (number - 1) * size
+        return [(player, -points) for points, _, player in self.ranking[start:start + size]]
+
+    def pages(self, size):
+        return max(1, -(-len(self.ranking) // size))
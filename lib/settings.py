@@ -4,14 +4,95 @@
 CLOSEST_GUESS_POINTS = 1
 EXACT_GUESS_POINTS = 2
 
+# Points per scoring rule, see lib/rules.py
+SCORING_RULES = {
+    'exact': EXACT_GUESS_POINTS,
+    'closest': CLOSEST_GUESS_POINTS,
+    'outcome': 0,  # Correct winner or draw
+    'goal_difference': 0,  # Correct winning margin
+}
+
+# Closed bets a player needs before showing up in leaderboards of rates and averages
+STATS_MIN_BETS = 5
+
+# Players per scoreboard page
+SCOREBOARD_PAGE_SIZE = 25
+
 # Time after match start after which a match will not be considered "upcoming"
 NEW_MATCH_TIME_OFFSET = 1800  # 30 Minutes
 
 # How soon bets can be placed before match start
 PRE_MATCH_BETTING_TIME = 7200  # 2 hours
 
+# Expected time from kickoff to final whistle, including half-time and stoppage
+MATCH_DURATION = 6300  # 105 Minutes
+
+# Bounds for polling the match source, checked every POLL_TICK seconds
+POLL_TICK = 5
+POLL_MIN_INTERVAL = 30
+POLL_MAX_INTERVAL = 3600  # 1 hour
+
+# football-data.org request quota (free tier)
+API_CALLS_PER_MINUTE = 10
+
+# football-data.org competition codes to track, and how many to fetch at once
+COMPETITIONS = ['WC']
+FETCH_WORKERS = 4
+
+# JSON lines file of match events to follow instead of polling football-data.org,
+# and how often to check it for new events in seconds
+MATCH_FEED = None
+FEED_POLL_INTERVAL = 0.2
+
+# Days of matches to fetch before and after today
+FETCH_DAYS_BEFORE = 1
+FETCH_DAYS_AFTER = 2
+
+# Connect and read timeouts for match data requests, in seconds
+FETCH_TIMEOUT = (3.05, 10)
+
+# Retries for failed requests, with jittered exponential backoff starting at FETCH_BACKOFF seconds
+FETCH_RETRIES = 2
+FETCH_BACKOFF = 0.5
+
+# Consecutive failed fetches before skipping calls for BREAKER_RESET_TIME seconds
+BREAKER_THRESHOLD = 3
+BREAKER_RESET_TIME = 300  # 5 Minutes
+
 # football-data.org API key
 API_KEY = "<your-api-key-here>"
 
 # Room/channel to announce in
 MAIN_ROOM = '#town-square'
+
+# Rooms/channels that each run their own betting pool, announcing in that room.
+# Direct messages and messages from other rooms go to the first pool.
+ROOMS = [MAIN_ROOM]
+
+# Directory for the game journal and snapshots (defaults to a directory in the bot's data dir)
+JOURNAL_DIR = None
+
+# Fsync the journal after this many changes or seconds, and snapshot after this many changes
+JOURNAL_SYNC_EVERY = 50
+JOURNAL_SYNC_INTERVAL = 2
+JOURNAL_SNAPSHOT_EVERY = 1000
+
+# Outgoing messages: bursts and sustained messages per second per room,
+# how long to collect bet acknowledgements for a digest and how often to send queued messages
+OUTBOX_BURST = 5
+OUTBOX_RATE = 1
+ACK_DIGEST_WINDOW = 1
+OUTBOX_FLUSH_INTERVAL = 0.5
+
+# Prometheus text file to write runtime metrics to for a textfile collector, and how often in seconds
+METRICS_FILE = None
+METRICS_INTERVAL = 15
+
+# Extra names users might use for teams, on top of the names and codes from the API
+TEAM_ALIASES = {
+    "Côte d'Ivoire": ['Ivory Coast', 'CIV'],
+    'Korea Republic': ['South Korea'],
+    'South Korea': ['Korea Republic'],
+    'United States': ['USA', 'US', 'America'],
+    'USA': ['United States', 'America'],
+}
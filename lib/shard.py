@@ -0,0 +1,55 @@
+from lib.actor import GameActor
+from lib.game import Game
+from lib.journal import Journal
+
+
+class Shard:
+    """
+    One betting pool: a game with its own journal and writer thread,
+    announcing in its own room.
+
+    Shards share nothing but the match source, so every pool can bet,
+    close rounds and restart without affecting the others.
+    """
+
+    def __init__(self, room, target, directory, stored=None):
+        self.room = room
+        # Identifier announcements are sent to
+        self.target = target
+        self.journal = Journal(directory)
+        # The journal is more recent than storage, which is only written on deactivation
+        if self.journal.exists:
+            game = self.journal.restore()
+        else:
+            game = stored or Game()
+        self.journal.attach(game)
+        # All changes to the game go through a single writer thread
+        self.engine = GameActor(game)
+
+    def __repr__(self):
+        return '<Shard {}>'.format(self.room)
+
+    @property
+    def view(self):
+        "Latest published state of the game"
+        return self.engine.view
+
+    def call(self, method, *args):
+        "Change the game on its writer thread and wait for the result"
+        return self.engine.call(method, *args)
+
+    def set_game(self, game):
+        "Switch to a game, keeping player history and journaling any changes to it"
+        def prepare(game):
+            game.history = self.engine.game.history
+            self.journal.attach(game)
+        self.engine.switch(game, prepare)
+
+    def sync(self):
+        self.journal.sync()
+
+    def stop(self):
+        "Finish pending changes and close the journal, returning the final game"
+        self.engine.stop()
+        self.journal.close()
+        return self.engine.game
@@ -0,0 +1,94 @@
+import re
+import unicodedata
+
+from lib.settings import TEAM_ALIASES
+
+
+def fold(name):
+    "Reduce a name to lowercase letters and digits without accents"
+    return ''.join(char for char in unicodedata.normalize('NFKD', name) if char.isalnum()).lower()
+
+
+class Node:
+    __slots__ = ('children', 'teams', 'exact')
+
+    def __init__(self):
+        self.children = {}
+        # Teams with an alias starting with / equal to the path to this node
+        self.teams = set()
+        self.exact = set()
+
+
+class TeamResolver:
+    """
+    Resolves loosely typed team names, abbreviations and aliases
+    to canonical team names using a prefix trie.
+
+    Any word in an alias can start a match, so "korea" finds "South Korea".
+    """
+
+    def __init__(self, aliases=None):
+        self.root = Node()
+        self.aliases = {}
+        for team, names in (aliases or {}).items():
+            self.add(team, *names)
+
+    def __contains__(self, team):
+        return team in self.aliases
+
+    @classmethod
+    def for_teams(cls, teams):
+        "Build resolver for a list of team names, including any configured aliases"
+        return cls({team: TEAM_ALIASES.get(team, ()) for team in teams})
+
+    @classmethod
+    def from_matches(cls, matches):
+        "Build resolver from football-data.org match data, including any configured aliases"
+        resolver = cls()
+        for match in matches:
+            for team in (match.get('homeTeam'), match.get('awayTeam')):
+                if team and team.get('name') and team['name'] not in resolver:
+                    resolver.add(team['name'], team.get('shortName'), team.get('tla'), *TEAM_ALIASES.get(team['name'], ()))
+        return resolver
+
+    def add(self, team, *aliases):
+        "Add a team under its own name and any number of aliases"
+        names = self.aliases.setdefault(team, set())
+        for name in (team,) + aliases:
+            if not name or name in names:
+                continue
+            names.add(name)
+            words = [fold(word) for word in re.split(r'[\s\-]+', name)]
+            for start in range(len(words)):
+                self.insert(''.join(words[start:]), team)
+
+    def insert(self, key, team):
+        node = self.root
+        for char in key:
+            node = node.children.setdefault(char, Node())
+            node.teams.add(team)
+        node.exact.add(team)
+
+    def resolve(self, name, among=None):
+        """
+        Find the team for a name in O(len(name))
+
+        Returns None if there is no match, or the name is ambiguous.
+        Pass `among` to only consider a subset of teams.
+        """
+        key = fold(name)
+        if not key:
+            return None
+        node = self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        # Prefer exact aliases over prefixes ("Niger" vs. "Nigeria")
+        for candidates in (node.exact, node.teams):
+            if among is not None:
+                candidates = candidates.intersection(among)
+            if len(candidates) == 1:
+                return next(iter(candidates))
+            if candidates:
+                return None
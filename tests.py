@@ -1,8 +1,98 @@
+import gzip
+import json
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from array import array
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+from benchmarks import suite
+from lib.actor import GameActor, GameView
+from lib.api import Competitions, FootballDataAPI, MatchIndex, MatchSource
+from lib.cache import RefreshingCache
+from lib.dispatch import Dispatcher
+from lib.feed import EventFeed
+from lib.fetch import CircuitBreaker, Fetcher, FetchError
 from lib.game import Game, GameError, Match, Round, Score
+from lib.journal import Journal
+from lib.metrics import Histogram, Metrics
+from lib import rules as rules_module
+from lib.outbox import Outbox
+from lib.ratelimit import TokenBucket
+from lib import replay
+from lib.rules import RuleSet, scoreline
+from lib.scheduler import PollScheduler
+from lib.scoreboard import Scoreboard
+from lib.shard import Shard
+from lib.settings import MAIN_ROOM, MATCH_DURATION, PRE_MATCH_BETTING_TIME
+from lib.teams import TeamResolver
 from errbot.backends.test import FullStackTest
 
 
+class StubAPIHandler(BaseHTTPRequestHandler):
+    "Local stand-in for the football-data.org API"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        fault = self.server.faults.pop(0) if self.server.faults else None
+        if fault == 'slow':
+            time.sleep(0.5)
+        elif fault == 'error':
+            self.send_error(500)
+            return
+        elif fault == 'malformed':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(b'<html>Bad gateway</html>')
+            return
+        if self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', self.server.etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubAPIServer(ThreadingHTTPServer):
+    "Serve a payload over HTTP on a random local port"
+
+    def __init__(self, payload, handler=StubAPIHandler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.payload = payload
+        self.etag = '"1"'
+        self.faults = []
+        self.requests = []
+        self.url = 'http://127.0.0.1:{}/v4/competitions/WC/matches'.format(self.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
 class TestBot(FullStackTest):
 
     def setUp(self):
@@ -27,9 +117,142 @@ class TestBot(FullStackTest):
         self.pop_message()
         self.push_message('!end match 0-0 Iceland')
         self.assertIn('Final score:', self.pop_message())
+        self.assertIn('Closed match', self.pop_message())
         self.push_message('!scoreboard')
         self.assertIn('None:1', self.pop_message())
 
+    def test_automatic_score(self):
+        self.push_message('!start match Iceland vs. Fireland')
+        self.pop_message()
+        self.pop_message()
+        self.push_message('hey bookiebot? 2-1 iceland')
+        self.assertIn('I read you', self.pop_message())
+        self.push_message(' 2-1 iceland')
+        self.push_message('!score 1-1')
+        self.assertEqual("Noted: None 2-1 Iceland, None 1-1", self.pop_message())
+
+    def test_scores(self):
+        self.push_message('!start match Iceland vs. Fireland')
+        self.pop_message()
+        self.pop_message()
+        self.push_message('!scores')
+        self.assertEqual('Iceland vs. Fireland: no bets yet', self.pop_message())
+        self.push_message('!score 2-1 Fireland')
+        self.pop_message()
+        self.push_message('!scores')
+        self.assertEqual('Iceland vs. Fireland: 1 bet (Iceland 0 / draw 0 / Fireland 1), picks: 2-1 Fireland x1', self.pop_message())
+        self.push_message('!scores Bob')
+        self.assertIn('Bob has no bets', self.pop_message())
+
+    def test_scoreboard_pages(self):
+        self.push_message('!scoreboard set {"Joe": 3, "Pete": 5, "Marcy": 3}')
+        self.pop_message()
+        self.push_message('!scoreboard top 2')
+        self.assertEqual('Scores: Pete:5 / Joe:3', self.pop_message())
+        self.push_message('!scoreboard page 1')
+        self.assertEqual('Scores: Pete:5 / Joe:3 / Marcy:3', self.pop_message())
+        self.push_message('!scoreboard page 2')
+        self.assertIn('Pick a page from 1 to 1', self.pop_message())
+
+    def test_rank(self):
+        self.push_message('!scoreboard set {"Joe": 3, "Pete": 5, "Marcy": 3, "Amanda": 1}')
+        self.pop_message()
+        self.push_message('!rank Joe')
+        self.assertEqual('Joe is tied #2 with 3 points.', self.pop_message())
+        self.push_message('!rank Amanda')
+        self.assertEqual('Amanda is #3 with 1 point.', self.pop_message())
+        self.push_message('!rank Bob')
+        self.assertIn('not on the scoreboard', self.pop_message())
+        self.push_message('!rank')
+        self.assertEqual('None is not on the scoreboard.', self.pop_message())
+
+    def test_match_events(self):
+        plugin = self.bot.plugin_manager.get_plugin_obj_by_name('BookieBot')
+        feed = EventFeed()
+        feed.subscribe(plugin.match_changed)
+        plugin.match_source = feed
+        kickoff = datetime.fromtimestamp(time.time() + 3600, timezone.utc).isoformat()
+        feed.push({'id': 7, 'utcDate': kickoff, 'status': 'TIMED', 'homeTeam': {'name': 'Iceland'}, 'awayTeam': {'name': 'Fireland'}})
+        self.assertIn('Now taking bets for Iceland vs. Fireland', self.pop_message())
+        self.push_message('!score 1-0 Iceland')
+        self.pop_message()
+        feed.push({'id': 7, 'status': 'FINISHED', 'score': {'fullTime': {'home': 1, 'away': 0}}})
+        self.assertIn('Final score: 1-0 Iceland', self.pop_message())
+
+    def test_start_matches(self):
+        plugin = self.bot.plugin_manager.get_plugin_obj_by_name('BookieBot')
+        feed = EventFeed()
+        plugin.match_source = feed
+        for number, hours in enumerate((0.5, 3, 48)):
+            kickoff = datetime.fromtimestamp(time.time() + hours * 3600, timezone.utc).isoformat()
+            feed.push({'id': number, 'utcDate': kickoff, 'status': 'TIMED', 'homeTeam': {'name': 'Home {}'.format(number)}, 'awayTeam': {'name': 'Away {}'.format(number)}})
+        feed.subscribe(plugin.match_changed)
+        # Only the match kicking off within the betting time opens, and only once
+        plugin.start_matches()
+        plugin.start_matches()
+        self.assertIn('Now taking bets for Home 0 vs. Away 0', self.pop_message())
+        self.assertEqual([rnd.match.uuid for rnd in plugin.default.view.active_rounds], [0])
+
+    def test_shards(self):
+        plugin = self.bot.plugin_manager.get_plugin_obj_by_name('BookieBot')
+        room = plugin.build_identifier('#pool-two')
+        # Pools are stored by room, whatever their position in ROOMS
+        self.assertEqual(plugin.storage_key(MAIN_ROOM), 'game')
+        self.assertEqual(plugin.storage_key('#pool-two'), 'game:#pool-two')
+        with tempfile.TemporaryDirectory() as directory:
+            plugin.shards[str(room)] = shard = Shard('#pool-two', room, directory)
+            feed = EventFeed()
+            feed.subscribe(plugin.match_changed)
+            plugin.match_source = feed
+            kickoff = datetime.fromtimestamp(time.time() + 3600, timezone.utc).isoformat()
+            # One event opens the match in every pool
+            feed.push({'id': 8, 'utcDate': kickoff, 'status': 'TIMED', 'homeTeam': {'name': 'Iceland'}, 'awayTeam': {'name': 'Fireland'}})
+            self.assertIn('Now taking bets', self.pop_message())
+            self.assertIn('Now taking bets', self.pop_message())
+            # Bets only count in the pool of the room they were made in
+            plugin.bet(SimpleNamespace(to=room, frm=SimpleNamespace(fullname='Joe')), '1-0 Iceland')
+            self.pop_message()
+            self.push_message('!score 2-2')
+            self.pop_message()
+            feed.push({'id': 8, 'status': 'FINISHED', 'score': {'fullTime': {'home': 1, 'away': 0}}})
+            finals = sorted([self.pop_message(), self.pop_message()])
+            self.assertIn('Joe gets 2 points', finals[0])
+            self.assertIn('None gets 1 point', finals[1])
+            self.assertEqual(shard.view.scoreboard.points, {'Joe': 2})
+            self.assertEqual(plugin.default.view.scoreboard.points, {None: 1})
+            del plugin.shards[str(room)]
+            shard.stop()
+
+    def test_player_stats(self):
+        self.push_message('!stats')
+        self.assertIn('None has no closed bets yet', self.pop_message())
+        self.push_message('!start match Iceland vs. Fireland')
+        self.pop_message()
+        self.pop_message()
+        self.push_message('!score 2-1 Iceland')
+        self.pop_message()
+        self.push_message('!end match 2-1 Iceland')
+        self.pop_message()
+        self.pop_message()
+        # History survives restarting the game
+        self.push_message('!init')
+        self.pop_message()
+        self.pop_message()
+        self.push_message('!stats')
+        self.assertEqual('None: 2 points from 1 bet, 1 exact (100%), 1 right outcome (100%), off by 0.0 goals on average, streak 1 (best 1).', self.pop_message())
+        self.push_message('!leaders best_streak')
+        self.assertEqual('best_streak: None:1', self.pop_message())
+        self.push_message('!leaders luck')
+        self.assertIn('with one of: points, bets', self.pop_message())
+
+    def test_bot_stats(self):
+        self.push_message('!scoreboard')
+        self.pop_message()
+        self.push_message('!stats bot')
+        stats = self.pop_message()
+        self.assertIn('command_seconds{command="scoreboard"}: ', stats)
+        self.assertIn('message_seconds: ', stats)
+
 
 class TestGame(unittest.TestCase):
     "Tests for game outcomes"
@@ -79,6 +302,32 @@ class TestGame(unittest.TestCase):
         self.game.new_round(Match(['Argentina', 'Peru']))
         self.assertRaises(GameError, self.game.close_round, '1-1')  
 
+    def test_route_by_team(self):
+        honduras = Match(['Honduras', 'Poland'])
+        argentina = Match(['Argentina', 'Peru'])
+        self.game.new_round(honduras)
+        self.game.new_round(argentina)
+        self.assertIs(self.game.route('2-1 PERU')[0].match, argentina)
+        self.assertIs(self.game.route('2-1 hond')[0].match, honduras)
+        self.assertEqual(self.game.route('3-0 Poland')[1], (3, 0, 'Poland'))
+        self.assertRaises(ValueError, self.game.route, '2-1 Paraguay')
+
+    def test_route_by_alias(self):
+        resolver = TeamResolver({'United States': ['USA'], 'Wales': ['WAL']})
+        self.game.new_round(Match(['United States', 'Wales'], resolver=resolver))
+        self.game.new_round(Match(['Argentina', 'Peru']))
+        self.game.add('1-0 usa', 'Joe')
+        self.game.add('1-0 WAL', 'Pete')
+        self.game.close_round('1-0 United States')
+        self.assertEqual(self.game.score_dict, {'Joe': 2, 'Pete': 0})
+
+    def test_route_after_close(self):
+        self.game.new_round(Match(['Honduras', 'Poland']))
+        self.game.new_round(Match(['Argentina', 'Peru']))
+        self.game.close_round('1-0 Peru')
+        self.assertEqual(set(self.game.teams), {'Honduras', 'Poland'})
+        self.assertRaises(ValueError, self.game.add, '1-0 Peru', 'Joe')
+
 
 class TestRound(unittest.TestCase):
     "Tests for round outcomes"
@@ -117,6 +366,124 @@ class TestRound(unittest.TestCase):
         self.assertEqual(len(self.round.winners), 3)
         self.assertEqual(self.round.winners, {'Pete': 1, 'Amanda': 1, 'Marcy': 1})
 
+    def test_histogram(self):
+        self.assertEqual(self.round.outcomes, [1, 3, 1])
+        self.assertEqual([(str(score), count) for score, count in self.round.popular], [('2-2', 2), ('2-0 Russia', 1), ('0-0', 1), ('4-1 Nigeria', 1)])
+        # Replaced bets move to their new scoreline
+        self.round.add('2-0 Russia', 'Marcy')
+        self.round.add('1-0 Nigeria', 'Joe')
+        self.assertEqual(self.round.outcomes, [2, 1, 2])
+        self.assertEqual(dict(self.round.histogram), {scoreline(0, 2): 2, scoreline(2, 2): 1, scoreline(1, 0): 1, scoreline(4, 1): 1})
+        self.assertEqual(str(self.round.bet('Joe')), '1-0 Nigeria by Joe')
+        self.assertIsNone(self.round.bet('Bob'))
+
+    def test_columns(self):
+        self.round.add('3-0 Nigeria', 'Joe')
+        self.assertEqual(self.round.authors, ['Pete', 'Joe', 'Amanda', 'Marcy', 'Anthony'])
+        self.assertEqual(list(self.round.home), [0, 3, 2, 2, 4])
+        self.assertEqual(list(self.round.away), [2, 0, 2, 2, 1])
+        self.assertEqual(str(self.round.scores['Joe']), '3-0 Nigeria by Joe')
+
+    def test_pickle(self):
+        restored = pickle.loads(pickle.dumps(self.round))
+        self.assertEqual(restored.scores.keys(), self.round.scores.keys())
+        restored.close('0-2 Nigeria')
+        self.assertEqual(restored.winners, {'Pete': 2})
+
+    def test_pickle_shared_resolver(self):
+        "Matches keep only their own teams of a competition-wide resolver"
+        resolver = TeamResolver({'Team {}'.format(number): ['T{}'.format(number)] for number in range(120)})
+        resolver.add('Korea Republic', 'South Korea', 'KOR')
+        match = Match(['Korea Republic', 'Team 1'], 7, resolver)
+        restored = pickle.loads(pickle.dumps(match))
+        self.assertEqual(set(restored.resolver.aliases), {'Korea Republic', 'Team 1'})
+        self.assertEqual(restored.get_team('south korea'), 'Korea Republic')
+        self.assertEqual(restored.get_team('T1'), 'Team 1')
+        self.assertLess(len(pickle.dumps(match)), len(pickle.dumps(resolver)) / 10)
+
+    def test_unpickle_score_objects(self):
+        "Rounds saved with a dictionary of Score objects should still load"
+        state = self.round.__getstate__()
+        scores = self.round.scores
+        for key in ('authors', 'slots', 'home', 'away', 'rules'):
+            del state[key]
+        state['scores'] = scores
+        restored = Round.__new__(Round)
+        restored.__setstate__(state)
+        self.assertEqual(restored.authors, self.round.authors)
+        self.assertEqual(restored.home, self.round.home)
+
+    def test_vectorized_close(self):
+        bets = [(author % 10, author // 10 % 10) for author in range(1000)]
+        rules = RuleSet(exact=3, closest=1, outcome=1)
+        home, away = array('B', (bet[0] for bet in bets)), array('B', (bet[1] for bet in bets))
+        vectorized = rules.points(home, away, scoreline(7, 7))
+        rules_module.numpy, numpy = None, rules_module.numpy
+        try:
+            self.assertEqual(rules.points(home, away, scoreline(7, 7)), vectorized)
+        finally:
+            rules_module.numpy = numpy
+
+
+class TestScoreboard(unittest.TestCase):
+    "Tests for the ranked scoreboard"
+
+    def setUp(self):
+        self.scoreboard = Scoreboard({'Marcy': 6, 'Joe': 1, 'Pete': 3, 'Amanda': 3})
+
+    def test_order(self):
+        self.assertEqual(list(self.scoreboard), [('Marcy', 6), ('Amanda', 3), ('Pete', 3), ('Joe', 1)])
+
+    def test_update(self):
+        self.scoreboard.add('Joe', 6)
+        self.scoreboard.add('Anthony', 0)
+        self.assertEqual(list(self.scoreboard), [('Joe', 7), ('Marcy', 6), ('Amanda', 3), ('Pete', 3), ('Anthony', 0)])
+        self.assertEqual(self.scoreboard.levels, [-7, -6, -3, 0])
+
+    def test_dense_rank(self):
+        self.assertEqual([self.scoreboard.rank(player) for player in ('Marcy', 'Amanda', 'Pete', 'Joe')], [1, 2, 2, 3])
+        self.scoreboard.add('Pete', 3)
+        self.assertEqual([self.scoreboard.rank(player) for player in ('Marcy', 'Pete', 'Amanda', 'Joe')], [1, 1, 2, 3])
+        self.assertFalse(self.scoreboard.tied('Amanda'))
+
+    def test_pages(self):
+        self.assertEqual(self.scoreboard.pages(3), 2)
+        self.assertEqual(self.scoreboard.page(2, 3), [('Joe', 1)])
+        self.assertEqual(self.scoreboard.top(1), [('Marcy', 6)])
+
+    def test_unnamed_players(self):
+        self.scoreboard.set(None, 3)
+        self.assertEqual(self.scoreboard.rank(None), 2)
+
+
+class TestRuleSet(unittest.TestCase):
+    "Tests for scoring rules"
+
+    def setUp(self):
+        self.rules = RuleSet(exact=5, closest=1, outcome=2, goal_difference=1)
+        self.predictions = {'Pete': scoreline(2, 1), 'Joe': scoreline(3, 2), 'Amanda': scoreline(1, 0), 'Marcy': scoreline(0, 0), 'Anthony': scoreline(0, 3)}
+
+    def test_exact(self):
+        self.assertEqual(self.rules.award(self.predictions, scoreline(2, 1)), {'Pete': 5, 'Joe': 3, 'Amanda': 3})
+
+    def test_closest(self):
+        self.assertEqual(self.rules.award(self.predictions, scoreline(4, 1)), {'Pete': 3, 'Joe': 3, 'Amanda': 2})
+        self.assertEqual(self.rules.award(self.predictions, scoreline(1, 1)), {'Pete': 1, 'Amanda': 1, 'Marcy': 3})
+
+    def test_tables_shared(self):
+        self.assertIs(RuleSet(exact=5).payoffs, RuleSet(exact=5).payoffs)
+
+    def test_pickle(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.rules)), self.rules)
+
+    def test_round_rules(self):
+        game = Game(rules=self.rules)
+        game.new_round(Match(['Nigeria', 'Russia']))
+        game.add('2-0 Russia', 'Pete')
+        game.add('1-1', 'Joe')
+        game.close_round('1-0 Russia')
+        self.assertEqual(game.score_dict, {'Pete': 3, 'Joe': 1})
+
 
 class TestScore(unittest.TestCase):
     "Tests for score creation and subtraction"
@@ -181,5 +548,772 @@ class TestScore(unittest.TestCase):
         self.assertRaises(TypeError, score_a.__sub__, score_b)
 
 
+class TestTeamResolver(unittest.TestCase):
+    "Tests for resolving team names"
+
+    def setUp(self):
+        self.resolver = TeamResolver.from_matches([
+            {'homeTeam': {'name': "Côte d'Ivoire", 'shortName': 'Ivory Coast', 'tla': 'CIV'}, 'awayTeam': {'name': 'United States', 'shortName': 'USA', 'tla': 'USA'}},
+            {'homeTeam': {'name': 'Niger', 'tla': 'NIG'}, 'awayTeam': {'name': 'Nigeria', 'tla': 'NGA'}},
+            {'homeTeam': {'name': 'South Korea', 'tla': 'KOR'}, 'awayTeam': {'name': 'South Africa', 'tla': 'RSA'}},
+        ])
+
+    def test_names(self):
+        self.assertEqual(self.resolver.resolve('Cote dIvoire'), "Côte d'Ivoire")
+        self.assertEqual(self.resolver.resolve('CÔTE'), "Côte d'Ivoire")
+        self.assertEqual(self.resolver.resolve('ivory'), "Côte d'Ivoire")
+        self.assertEqual(self.resolver.resolve('  united states '), 'United States')
+
+    def test_codes(self):
+        self.assertEqual(self.resolver.resolve('civ'), "Côte d'Ivoire")
+        self.assertEqual(self.resolver.resolve('USA'), 'United States')
+        self.assertEqual(self.resolver.resolve('America'), 'United States')
+
+    def test_words(self):
+        self.assertEqual(self.resolver.resolve('korea'), 'South Korea')
+        self.assertEqual(self.resolver.resolve('africa'), 'South Africa')
+
+    def test_ambiguous(self):
+        self.assertEqual(self.resolver.resolve('Niger'), 'Niger')
+        self.assertEqual(self.resolver.resolve('Nigeri'), 'Nigeria')
+        self.assertIsNone(self.resolver.resolve('South'))
+        self.assertEqual(self.resolver.resolve('South', among=['South Korea', 'Peru']), 'South Korea')
+
+    def test_unknown(self):
+        self.assertIsNone(self.resolver.resolve('Paraguay'))
+        self.assertIsNone(self.resolver.resolve(''))
+
+    def test_match_cache(self):
+        match = Match(['Niger', 'Nigeria'], resolver=self.resolver)
+        self.assertEqual(match.get_team('nga'), 'Nigeria')
+        self.assertEqual(match.team_cache, {'nga': 'Nigeria'})
+        self.assertIsNone(match.get_team('USA'))
+
+
+class TestDispatcher(unittest.TestCase):
+    "Tests for routing chat messages"
+
+    class Message:
+        def __init__(self, body):
+            self.body = body
+
+    def setUp(self):
+        self.calls = []
+        self.dispatcher = Dispatcher()
+        self.dispatcher.on('adam', lambda msg: self.calls.append('adam'))
+        self.dispatcher.on('bookiebot?', lambda msg: self.calls.append('hello'))
+        self.dispatcher.on_score(lambda msg, score: self.calls.append(score))
+
+    def dispatch(self, body):
+        self.calls = []
+        self.dispatcher.dispatch(self.Message(body))
+        return self.calls
+
+    def test_triggers(self):
+        self.assertEqual(self.dispatch('Adam, ADAM, are you there BookieBot?'), ['adam', 'hello'])
+        self.assertEqual(self.dispatch('nothing to see here'), [])
+
+    def test_scores(self):
+        self.assertEqual(self.dispatch('  2 - 1 Brazil'), [(2, 1, 'Brazil')])
+        self.assertEqual(self.dispatch('0-0'), [(0, 0, None)])
+
+    def test_not_scores(self):
+        for body in ('', '   ', 'we won 2-1', '2021 was a good year', 'Brazil 2-1', '1 -'):
+            self.assertEqual(self.dispatch(body), [], body)
+
+
+class TestOutbox(unittest.TestCase):
+    "Tests for coalesced outgoing messages"
+
+    def setUp(self):
+        self.sent = []
+        self.outbox = Outbox(lambda target, text, in_reply_to: self.sent.append((target, text, in_reply_to)), window=1, burst=2, rate=0.001)
+
+    def test_immediate(self):
+        self.outbox.post('#room', 'Hello')
+        self.assertEqual(self.sent, [('#room', 'Hello', None)])
+
+    def test_rate_limit_merges(self):
+        for number in range(5):
+            self.outbox.post('#room', str(number))
+        self.assertEqual([text for _, text, _ in self.sent], ['0', '1'])
+        # Room is out of tokens until the bucket refills
+        self.assertEqual(self.outbox.flush(time.monotonic() + 1), 0)
+        self.outbox.rooms['#room'].bucket.tokens = 1
+        self.outbox.flush(time.monotonic() + 1)
+        self.assertEqual(self.sent[-1], ('#room', '2\n3\n4', None))
+
+    def test_digest(self):
+        self.outbox.acknowledge('#room', 'Ann 2-1 Brazil', 'msg1')
+        self.outbox.acknowledge('#room', 'Bob 0-0', 'msg2')
+        self.outbox.acknowledge('#other', 'Cat 1-0 Peru', 'msg3')
+        self.assertEqual(self.outbox.flush(), 0)
+        self.assertEqual(self.outbox.flush(time.monotonic() + 1), 2)
+        self.assertEqual(self.sent, [('#room', 'Noted: Ann 2-1 Brazil, Bob 0-0', None), ('#other', 'Noted: Cat 1-0 Peru', 'msg3')])
+        self.assertEqual(self.outbox.flush(time.monotonic() + 2), 0)
+
+
+class TestGameActor(unittest.TestCase):
+    "Tests for serialized game changes"
+
+    def setUp(self):
+        self.actor = GameActor(Game())
+        self.actor.call('new_round', Match(['Honduras', 'Poland']))
+        self.actor.call('new_round', Match(['Argentina', 'Peru']))
+
+    def tearDown(self):
+        self.actor.stop()
+
+    def test_errors(self):
+        self.assertRaises(GameError, self.actor.call, 'add', '1-1', 'Pete')
+        self.assertRaises(ValueError, self.actor.call, 'add', '1-0 Paraguay', 'Pete')
+
+    def test_read_own_writes(self):
+        self.actor.call('add', '1-0 Peru', 'Pete')
+        self.assertIn('Pete', self.actor.view.scoreboard)
+
+    def test_view_is_copy(self):
+        view = self.actor.view
+        self.actor.call('add', '1-0 Peru', 'Pete')
+        self.assertEqual([rnd.authors for rnd in view.active_rounds], [[], []])
+        self.assertNotIn('Pete', view.scoreboard)
+
+    def test_unchanged_copies_reused(self):
+        self.actor.call('add', '1-0 Peru', 'Pete')
+        view = self.actor.view
+        self.actor.call('add', '2-0 Peru', 'Pete')
+        rounds = {str(rnd): rnd for rnd in view.active_rounds}
+        changed = {str(rnd): rnd for rnd in self.actor.view.active_rounds}
+        # Only the round bet on is copied again, and Pete is already on the scoreboard
+        self.assertIs(changed['Honduras vs. Poland'], rounds['Honduras vs. Poland'])
+        self.assertIsNot(changed['Argentina vs. Peru'], rounds['Argentina vs. Peru'])
+        self.assertIs(self.actor.view.scoreboard, view.scoreboard)
+        self.assertIs(self.actor.view.history, view.history)
+        self.actor.call('add', '2-0 Peru', 'Joe')
+        self.assertIsNot(self.actor.view.scoreboard, view.scoreboard)
+
+    def test_stopped(self):
+        self.actor.stop()
+        # Nothing would ever run the change, so fail instead of waiting forever
+        self.assertRaises(RuntimeError, self.actor.call, 'add', '1-0 Peru', 'Pete', timeout=1)
+
+    def test_stress(self):
+        players = ['Player {}'.format(number) for number in range(400)]
+        errors = []
+        done = threading.Event()
+
+        def bet(player):
+            try:
+                for goals in range(5):
+                    self.actor.call('add', '{}-0 {}'.format(goals, 'Peru' if hash(player) % 2 else 'Poland'), player)
+            except Exception as error:
+                errors.append(error)
+
+        def read():
+            while not done.is_set():
+                view = self.actor.view
+                # Everybody who placed a bet must be on the scoreboard
+                for rnd in view.active_rounds:
+                    if not set(rnd.authors) <= set(view.scoreboard.points):
+                        errors.append(AssertionError('Inconsistent view'))
+                time.sleep(0.001)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        writers = [threading.Thread(target=bet, args=(player,)) for player in players]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        self.actor.call('close_round', '4-0 Peru')
+        self.actor.call('close_round', '4-0 Poland')
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        view = self.actor.view
+        self.assertEqual(len(view.scoreboard), 400)
+        # Last bet for everyone was exactly right
+        self.assertEqual(set(points for _, points in view.scores), {2})
+
+
+class TestJournal(unittest.TestCase):
+    "Tests for restoring games from the journal"
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = Journal(self.directory.name, snapshot_every=5)
+        self.game = Game({'Marcy': 3})
+        self.journal.attach(self.game)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def play(self):
+        self.game.new_round(Match(['United States', 'Wales'], resolver=TeamResolver({'United States': ['USA'], 'Wales': []})))
+        self.game.add('1-1', 'Pete')
+        self.game.add('2-1 USA', 'Joe')
+        self.game.close_round('2-1 United States')
+        self.game.new_round(Match(['Argentina', 'Peru']))
+        self.game.add('1-0 Peru', 'Pete')
+
+    def restore(self):
+        return Journal(self.directory.name).restore()
+
+    def test_restore(self):
+        self.play()
+        game = self.restore()
+        self.assertEqual(game.scores, [('Marcy', 3), ('Joe', 2), ('Pete', 0)])
+        rnd = next(iter(game.active_rounds))
+        self.assertEqual(rnd.scores['Pete']['Peru'], 1)
+
+    def test_snapshot(self):
+        self.play()
+        # Snapshot was taken after five changes, so only one is left in the journal
+        with open(self.journal.journal_path) as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+        self.assertEqual(self.restore().scores, [('Marcy', 3), ('Joe', 2), ('Pete', 0)])
+
+    def test_crash_during_snapshot(self):
+        self.journal.snapshot_every = 100
+        self.play()
+        with open(self.journal.journal_path, 'rb') as journal:
+            tail = journal.read()
+        self.journal.snapshot()
+        self.journal.close()
+        # Journal was not emptied before crashing, so nothing in it should be replayed
+        with open(self.journal.journal_path, 'wb') as journal:
+            journal.write(tail)
+        self.assertEqual(self.restore().scores, [('Marcy', 3), ('Joe', 2), ('Pete', 0)])
+
+    def test_partial_line(self):
+        self.game.new_round(Match(['Argentina', 'Peru']))
+        self.game.add('1-0 Peru', 'Pete')
+        with open(self.journal.journal_path, 'a') as journal:
+            journal.write('[3, "add", "2-')
+        game = self.restore()
+        self.assertEqual(list(next(iter(game.active_rounds)).scores), ['Pete'])
+
+    def test_alias_restored(self):
+        self.game.new_round(Match(['United States', 'Wales'], resolver=TeamResolver({'United States': ['USA'], 'Wales': []})))
+        game = self.restore()
+        game.add('1-0 usa', 'Joe')
+
+
+class TestMatchIndex(unittest.TestCase):
+    "Tests for API match lookups"
+
+    def setUp(self):
+        self.index = MatchIndex([
+            {'id': 3, 'utcDate': '2022-11-21T16:00:00Z'},
+            {'id': 1, 'utcDate': '2022-11-20T16:00:00Z'},
+            {'id': 2, 'utcDate': '2022-11-21T13:00:00Z'},
+        ])
+
+    def test_get(self):
+        self.assertEqual(self.index.get(2)['utcDate'], '2022-11-21T13:00:00Z')
+        self.assertIsNone(self.index.get(4))
+
+    def test_since(self):
+        self.assertEqual([m['id'] for m in self.index.since(0)], [1, 2, 3])
+        self.assertEqual([m['id'] for m in self.index.since(1669035600)], [2, 3])
+        self.assertEqual(self.index.since(1669046400 + 1), [])
+
+    def test_between(self):
+        self.assertEqual([m['id'] for m in self.index.between(1668960000, 1669046400)], [1, 2])
+
+
+class TestFootballDataAPI(unittest.TestCase):
+    "Tests for fetching from the match API"
+
+    payload = {'matches': [
+        {'id': 1, 'utcDate': '2022-11-20T16:00:00Z'},
+        {'id': 2, 'utcDate': '2022-11-21T13:00:00Z'},
+    ]}
+
+    def test_conditional_fetch(self):
+        with StubAPIServer(self.payload) as server:
+            api = FootballDataAPI(server.url)
+            self.assertEqual(api.get_match(2)['utcDate'], '2022-11-21T13:00:00Z')
+            index = api.index
+            api.cache.time -= api.CACHE_TIME + 1
+            self.assertEqual(api.get_match(1)['utcDate'], '2022-11-20T16:00:00Z')
+            api.cache.wait()
+            # Payload unchanged, so the index should not be rebuilt
+            self.assertIs(api.index, index)
+        self.assertEqual(len(server.requests), 2)
+        self.assertNotIn('If-None-Match', server.requests[0][1])
+        self.assertEqual(server.requests[1][1]['If-None-Match'], '"1"')
+        self.assertIn('gzip', server.requests[0][1]['Accept-Encoding'])
+
+    def test_warm_start(self):
+        with StubAPIServer(self.payload) as server, tempfile.TemporaryDirectory() as directory:
+            api = FootballDataAPI(server.url)
+            api.persist(directory)
+            api.index
+            # A restarted bot starts from the snapshot without waiting for the network
+            server.faults = ['slow']
+            restarted = FootballDataAPI(server.url)
+            restarted.persist(directory)
+            start = time.monotonic()
+            self.assertEqual(restarted.get_match(2)['utcDate'], '2022-11-21T13:00:00Z')
+            self.assertLess(time.monotonic() - start, 0.25)
+            self.assertEqual(restarted.cache.stats['misses'], 0)
+            # Stale snapshots are revalidated in the background
+            restarted.cache.time -= restarted.CACHE_TIME + 1
+            restarted.index
+            restarted.cache.wait()
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[1][1]['If-None-Match'], '"1"')
+
+    def test_lazy_imports(self):
+        loaded = subprocess.run(
+            [sys.executable, '-c', 'import sys, lib.api, lib.game; print(sorted({"requests", "numpy"} & set(sys.modules)))'],
+            capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(loaded.stdout.strip(), '[]')
+
+    def test_date_window(self):
+        with StubAPIServer(self.payload) as server:
+            FootballDataAPI(server.url).data
+        self.assertIn('dateFrom=', server.requests[0][0])
+        self.assertIn('dateTo=', server.requests[0][0])
+
+
+class TestCompetitions(unittest.TestCase):
+    "Tests for tracking several competitions at once"
+
+    def test_merged_index(self):
+        euro = {'matches': [{'id': 3, 'utcDate': '2024-06-14T19:00:00Z', 'homeTeam': {'name': 'Germany'}, 'awayTeam': {'name': 'Scotland'}}]}
+        with StubAPIServer(TestFootballDataAPI.payload) as world_cup, StubAPIServer(euro) as euros:
+            competitions = Competitions(codes=())
+            competitions.add('WC', world_cup.url)
+            competitions.add('EC', euros.url)
+            index = competitions.index
+            self.assertEqual([match['id'] for match in index.matches], [1, 2, 3])
+            self.assertEqual(competitions.get_match(3)['utcDate'], '2024-06-14T19:00:00Z')
+            self.assertEqual(index.teams.resolve('scot'), 'Scotland')
+            # Unchanged competitions keep the merged index
+            self.assertIs(competitions.index, index)
+            self.assertIn('EC: Circuit breaker closed', competitions.status)
+
+    def test_refresh_overdue(self):
+        euro = {'matches': [{'id': 3, 'utcDate': '2024-06-14T19:00:00Z', 'homeTeam': {'name': 'Germany'}, 'awayTeam': {'name': 'Scotland'}}]}
+        with StubAPIServer(TestFootballDataAPI.payload) as world_cup, StubAPIServer(euro) as euros:
+            competitions = Competitions(codes=())
+            competitions.add('WC', world_cup.url)
+            competitions.add('EC', euros.url)
+            competitions.index
+            # Only the competition with the overdue match spends an API call
+            self.assertTrue(competitions.refresh({3}))
+            competitions.sources['EC'].cache.wait()
+            self.assertEqual(competitions.sources['WC'].cache.refreshes, 0)
+            self.assertEqual(competitions.sources['EC'].cache.refreshes, 1)
+        self.assertEqual(len(world_cup.requests), 1)
+        self.assertEqual(len(euros.requests), 2)
+
+    def test_failed_competition(self):
+        with StubAPIServer(TestFootballDataAPI.payload) as world_cup:
+            competitions = Competitions(codes=())
+            competitions.add('WC', world_cup.url)
+            # Nothing listens on the port of a closed server
+            with StubAPIServer({}) as dead:
+                pass
+            competitions.add('XX', dead.url)
+            competitions.sources['XX'].fetcher.retries = 0
+            with self.assertLogs('lib.api', 'WARNING'):
+                self.assertEqual([match['id'] for match in competitions.index.matches], [1, 2])
+            # Every lookup tries the failed competition again, until its breaker opens
+            with self.assertLogs('lib.api', 'WARNING'):
+                self.assertEqual(competitions.get_match(2)['utcDate'], '2022-11-21T13:00:00Z')
+            self.assertIn('XX: Circuit breaker closed (2 failures), no data yet, ', competitions.status)
+            self.assertIn('last fetch failed: Fetching', competitions.status)
+            self.assertNotIn('failed', competitions.status.splitlines()[0])
+
+    def test_shared_quota(self):
+        with StubAPIServer(TestFootballDataAPI.payload) as server:
+            competitions = Competitions(codes=())
+            competitions.quota = TokenBucket(2, 4)
+            for code in ('WC', 'EC', 'CL'):
+                competitions.add(code, server.url)
+            start = time.monotonic()
+            competitions.index
+            # Two calls fit the burst, the third waits for a token
+            self.assertGreater(time.monotonic() - start, 0.2)
+        self.assertEqual(len(server.requests), 3)
+
+
+class TestEventFeed(unittest.TestCase):
+    "Tests for the pushed match source"
+
+    event = {'id': 1, 'utcDate': '2022-11-20T16:00:00Z', 'status': 'TIMED', 'homeTeam': {'name': 'Qatar'}, 'awayTeam': {'name': 'Ecuador'}}
+
+    def test_push(self):
+        feed = EventFeed()
+        changed = []
+        feed.subscribe(changed.append)
+        feed.push(self.event)
+        index = feed.index
+        self.assertEqual(index.get(1)['status'], 'TIMED')
+        # Events only need the fields that changed
+        feed.push({'id': 1, 'status': 'IN_PLAY'})
+        self.assertIsNot(feed.index, index)
+        self.assertEqual(feed.get_match(1)['homeTeam'], {'name': 'Qatar'})
+        self.assertEqual([match['status'] for match in changed], ['TIMED', 'IN_PLAY'])
+
+    def test_follow(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.jsonl')
+            feed = EventFeed(path, interval=0.01)
+            changed = queue.SimpleQueue()
+            feed.subscribe(changed.put)
+            feed.start()
+            try:
+                with open(path, 'w') as events:
+                    events.write(json.dumps(self.event) + '\nnot json\n{"id": 1, "sta')
+                    events.flush()
+                    self.assertEqual(changed.get(timeout=1)['status'], 'TIMED')
+                    # Half written lines wait for the rest
+                    events.write('tus": "FINISHED"}\n')
+                    events.flush()
+                    self.assertEqual(changed.get(timeout=1)['status'], 'FINISHED')
+            finally:
+                feed.stop()
+        self.assertEqual(feed.events, 2)
+
+    def test_incomplete_source(self):
+        class Source(MatchSource):
+            pass
+        # Sources without an index fail when created, not on the first poll
+        self.assertRaises(TypeError, Source)
+
+
+class TestReplay(unittest.TestCase):
+    "Tests for backtesting recorded tournaments"
+
+    matches = [
+        {'id': 1, 'utcDate': '2022-11-20T16:00:00Z', 'status': 'FINISHED', 'homeTeam': {'name': 'Qatar'}, 'awayTeam': {'name': 'Ecuador'}, 'score': {'fullTime': {'home': 0, 'away': 2}}},
+        {'id': 2, 'utcDate': '2022-11-21T13:00:00Z', 'status': 'FINISHED', 'homeTeam': {'name': 'England'}, 'awayTeam': {'name': 'Iran'}, 'score': {'fullTime': {'home': 6, 'away': 2}}},
+    ]
+    chat = [
+        {'time': '2022-11-20T12:00:00Z', 'author': 'Joe', 'body': '2-0 ecuador'},  # Too early
+        {'time': '2022-11-20T15:00:00Z', 'author': 'Joe', 'body': '2-0 ecuador'},
+        {'time': '2022-11-20T15:10:00Z', 'author': 'Pete', 'body': '!score 1-1'},
+        {'time': '2022-11-20T15:20:00Z', 'author': 'Marcy', 'body': 'qatar all the way'},
+        {'time': '2022-11-21T11:30:00Z', 'author': 'Pete', 'body': '3-1 England'},
+        {'time': '2022-11-21T11:45:00Z', 'author': 'Marcy', 'body': '1-0 iran'},
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.chat_path = os.path.join(self.directory.name, 'chat.jsonl')
+        self.results_path = os.path.join(self.directory.name, 'matches.json')
+        with open(self.chat_path, 'w') as chat:
+            chat.writelines(json.dumps(message) + '\n' for message in self.chat)
+        with open(self.results_path, 'w') as results:
+            json.dump({'matches': self.matches}, results)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_timeline(self):
+        events = replay.timeline(replay.read_chat(self.chat_path), self.matches, betting_time=3600)
+        kinds = [kind for _, kind, _ in events]
+        # Betting opens at the same instant as Joe's bet, so the round opens first
+        self.assertEqual(kinds[:6], [replay.MESSAGE, replay.OPEN, replay.MESSAGE, replay.MESSAGE, replay.MESSAGE, replay.CLOSE])
+        self.assertEqual(kinds[6:], [replay.MESSAGE, replay.MESSAGE, replay.OPEN, replay.CLOSE])
+
+    def test_defaults(self):
+        [(variant, leaderboard)] = replay.run(self.chat_path, self.results_path, workers=1)
+        self.assertEqual(variant, {})
+        self.assertEqual(leaderboard, [('Joe', 2), ('Pete', 1), ('Marcy', 0)])
+
+    def test_variants(self):
+        variants = replay.variants(['exact=5', 'betting_time=3600,10800'])
+        self.assertEqual(variants, [{'exact': 5, 'betting_time': 3600}, {'exact': 5, 'betting_time': 10800}])
+        results = replay.run(self.chat_path, self.results_path, variants, workers=2)
+        # Bets on England vs. Iran came in too early when betting opens an hour before kickoff
+        self.assertEqual(results[0][1], [('Joe', 5), ('Pete', 0)])
+        self.assertEqual(results[1][1], [('Joe', 5), ('Pete', 1), ('Marcy', 0)])
+        with self.assertRaises(ValueError):
+            replay.variants(['jackpot=1'])
+
+
+class TestBenchmarks(unittest.TestCase):
+    "Tests for the benchmark suite itself"
+
+    def test_tournament(self):
+        tournament = suite.Tournament(players=10, rounds=3, messages=100, burst=20)
+        self.assertEqual(len(tournament.messages), 100)
+        self.assertEqual(len(tournament.fixtures), 3)
+        self.assertEqual(len(tournament.scores), 70)
+        self.assertEqual(len(tournament.game().active_rounds), 3)
+
+    def test_callback_message(self):
+        tournament = suite.Tournament(players=10, rounds=3, messages=100, burst=20, repeat=1)
+        self.assertGreater(suite.callback_message(tournament), 0)
+
+    def test_regressions(self):
+        baseline = {'game_add': 1.0, 'round_close': 2.0}
+        results = {'game_add': 1.2, 'round_close': 3.0, 'game_scores': 5.0}
+        self.assertEqual(suite.regressions(results, baseline, 0.25), [('round_close', 2.0, 3.0)])
+
+
+class TestMetrics(unittest.TestCase):
+    "Tests for runtime instrumentation"
+
+    def test_histogram(self):
+        histogram = Histogram(bounds=(0.001, 0.01, 0.1))
+        for value in (0.0005, 0.002, 0.003, 0.05, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 0.01)
+        # Values above the highest bound are reported as the highest bound
+        self.assertEqual(histogram.quantile(1), 0.1)
+        self.assertEqual(Histogram().quantile(0.5), 0)
+
+    def test_timed(self):
+        metrics = Metrics()
+
+        @metrics.timed('call_seconds', by='function')
+        def numbers():
+            yield 1
+            yield 2
+
+        self.assertEqual(list(numbers()), [1, 2])
+        self.assertEqual(numbers.__name__, 'numbers')
+        self.assertEqual(metrics.histogram('call_seconds', function='numbers').count, 1)
+        with metrics.timer('block_seconds'):
+            pass
+        self.assertIn('block_seconds: 1 calls', metrics.summary())
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.observe('fetch_seconds', 0.0003)
+        metrics.count('fetch_responses_total', status='200')
+        metrics.count('fetch_responses_total', status='200')
+        metrics.gauge('cache_hits', lambda: 7, competition='WC')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bookiebot.prom')
+            metrics.write(path)
+            with open(path) as exported:
+                lines = exported.read().splitlines()
+        self.assertIn('# TYPE fetch_seconds histogram', lines)
+        self.assertIn('fetch_seconds_bucket{le="0.0002"} 0', lines)
+        self.assertIn('fetch_seconds_bucket{le="0.0004"} 1', lines)
+        self.assertIn('fetch_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('fetch_seconds_count 1', lines)
+        self.assertIn('fetch_responses_total{status="200"} 2', lines)
+        self.assertIn('cache_hits{competition="WC"} 7', lines)
+
+
+class TestHistory(unittest.TestCase):
+    "Tests for player statistics over closed rounds"
+
+    def setUp(self):
+        self.game = Game()
+        for bets, final_score in (
+            ({'Joe': '2-1 Poland', 'Pete': '1-1', 'Marcy': '0-3 Poland'}, '2-1 Poland'),
+            ({'Joe': '1-0 Poland', 'Pete': '3-0 Poland'}, '1-1'),
+            ({'Joe': '2-0 Poland', 'Pete': '2-1 Honduras', 'Marcy': '2-2'}, '1-0 Honduras'),
+        ):
+            self.game.new_round(Match(['Honduras', 'Poland']))
+            for author, score in bets.items():
+                self.game.add(score, author)
+            self.game.close_round(final_score)
+
+    def test_totals(self):
+        joe = self.game.history['Joe']
+        self.assertEqual((joe.bets, joe.points, joe.exact, joe.outcomes, joe.error), (3, 3, 1, 1, 4))
+        self.assertEqual((joe.streak, joe.best_streak), (0, 2))
+        pete = self.game.history['Pete']
+        self.assertEqual((pete.points, pete.outcomes, pete.streak, pete.best_streak), (1, 1, 1, 1))
+        self.assertEqual(pete.average_error, 2)
+        self.assertEqual(self.game.history['Marcy'].bets, 2)
+        self.assertEqual(self.game.history.rounds, 3)
+
+    def test_leaderboard(self):
+        history = self.game.history
+        self.assertEqual(history.leaderboard('points'), [('Joe', 3), ('Pete', 1), ('Marcy', 0)])
+        self.assertEqual(history.leaderboard('best_streak', 1), [('Joe', 2)])
+        # Too few bets for rates
+        self.assertEqual(history.leaderboard('exact_rate'), [])
+        with patch('lib.history.STATS_MIN_BETS', 2):
+            history = history.copy()
+            self.assertEqual(history.leaderboard('average_error'), [('Joe', 4 / 3), ('Pete', 2), ('Marcy', 3.5)])
+
+    def test_head_to_head(self):
+        self.assertEqual(self.game.history.head_to_head('Joe', 'Pete'), (2, 1, 0))
+        self.assertEqual(self.game.history.head_to_head('Marcy', 'Joe'), (0, 1, 1))
+
+    def test_kept_across_games(self):
+        view = GameView(self.game)
+        self.assertIs(GameView(self.game, view).history, view.history)
+        actor = GameActor(self.game)
+        shard = SimpleNamespace(engine=actor, journal=SimpleNamespace(attach=lambda game: None))
+        Shard.set_game(shard, Game())
+        self.assertIs(actor.game.history, self.game.history)
+        actor.stop()
+
+    def test_pickle(self):
+        history = pickle.loads(pickle.dumps(self.game)).history
+        self.assertEqual(history['Joe'].errors.tolist(), [0, 1, 3])
+        self.assertEqual(history.leaderboard('points', 1), [('Joe', 3)])
+
+
+class TestFetcher(unittest.TestCase):
+    "Tests for fetching from a misbehaving upstream"
+
+    payload = {'matches': []}
+
+    def fetcher(self, url):
+        return Fetcher(url, timeout=(1, 0.2), retries=2, backoff=0.01, breaker=CircuitBreaker(threshold=2, reset_time=60))
+
+    def test_retry_faults(self):
+        for fault in ('slow', 'error', 'malformed'):
+            with StubAPIServer(self.payload) as server:
+                server.faults = [fault, fault]
+                self.assertEqual(self.fetcher(server.url).get(), (self.payload, True))
+            self.assertEqual(len(server.requests), 3)
+
+    def test_give_up(self):
+        with StubAPIServer(self.payload) as server:
+            server.faults = ['error'] * 3
+            fetcher = self.fetcher(server.url)
+            self.assertRaises(FetchError, fetcher.get)
+            self.assertEqual(fetcher.breaker.state, 'closed')
+
+    def test_circuit_breaker(self):
+        with StubAPIServer(self.payload) as server:
+            server.faults = ['error'] * 6
+            fetcher = self.fetcher(server.url)
+            self.assertRaises(FetchError, fetcher.get)
+            self.assertRaises(FetchError, fetcher.get)
+            self.assertEqual(fetcher.breaker.state, 'open')
+            # Open breaker skips calls entirely
+            self.assertRaises(FetchError, fetcher.get)
+            self.assertEqual(len(server.requests), 6)
+            fetcher.breaker.opened_at -= 60
+            self.assertEqual(fetcher.breaker.state, 'half-open')
+            self.assertEqual(fetcher.get(), (self.payload, True))
+            self.assertEqual(fetcher.breaker.state, 'closed')
+
+    def test_payload_without_matches(self):
+        with StubAPIServer({'message': 'The resource you are looking for is restricted.'}) as server:
+            api = FootballDataAPI(server.url)
+            api.fetcher.backoff = 0.01
+            api.fetcher.breaker = CircuitBreaker(threshold=2)
+            for _ in range(2):
+                self.assertRaisesRegex(FetchError, 'restricted', api.fetch)
+            self.assertEqual(api.fetcher.breaker.state, 'open')
+        # Unusable payloads are retried like any other failure
+        self.assertEqual(len(server.requests), 6)
+
+    def test_serve_last_snapshot(self):
+        payload = {'matches': [{'id': 1, 'utcDate': '2022-11-20T16:00:00Z'}]}
+        with StubAPIServer(payload) as server:
+            api = FootballDataAPI(server.url)
+            api.fetcher.retries = 0
+            api.fetcher.breaker = CircuitBreaker(threshold=1)
+            api.data
+            server.faults = ['malformed']
+            server.etag = '"2"'
+            api.cache.time -= api.CACHE_TIME + 1
+            api.data
+            api.cache.wait()
+            self.assertEqual(api.fetcher.breaker.state, 'open')
+            self.assertEqual(api.get_match(1)['id'], 1)
+            self.assertIn('Circuit breaker open', api.status)
+
+
+class TestRefreshingCache(unittest.TestCase):
+    "Tests for the single-flight API cache"
+
+    def setUp(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.cache = RefreshingCache(self.fetch, 60)
+
+    def fetch(self):
+        self.calls += 1
+        self.release.wait(5)
+        return self.calls
+
+    def test_single_flight_miss(self):
+        self.release.set()
+        threads = [threading.Thread(target=self.cache.get) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_stale_while_revalidate(self):
+        self.release.set()
+        self.assertEqual(self.cache.get(), 1)
+        self.release.clear()
+        self.cache.time -= 61
+        # Stale value is served immediately while one refresh runs
+        self.assertEqual(self.cache.get(), 1)
+        self.assertEqual(self.cache.get(), 1)
+        self.assertEqual(self.cache.stats, {'hits': 2, 'misses': 1, 'refreshes': 1})
+        self.release.set()
+        self.cache.wait()
+        self.assertEqual(self.cache.get(), 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_failed_refresh_keeps_value(self):
+        self.release.set()
+        self.cache.get()
+        self.cache.fetch = lambda: 1 / 0
+        self.cache.time -= 61
+        self.cache.get()
+        self.cache.wait()
+        self.assertEqual(self.cache.value, 1)
+        self.assertTrue(self.cache.stale)
+
+
+class TestPollScheduler(unittest.TestCase):
+    "Tests for adaptive polling"
+
+    kickoff = 1669046400  # 2022-11-21T16:00:00Z
+
+    def setUp(self):
+        self.index = MatchIndex([{'id': 1, 'utcDate': '2022-11-21T16:00:00Z'}])
+        self.scheduler = PollScheduler(min_interval=30, max_interval=3600, calls_per_minute=10)
+        self.round = Round(Match(['Honduras', 'Poland'], 1))
+
+    def test_backoff(self):
+        now = self.kickoff - 86400
+        delays = [self.scheduler.plan(self.index, [], now=now) for _ in range(8)]
+        self.assertEqual(delays, [60, 120, 240, 480, 960, 1920, 3600, 3600])
+
+    def test_wake_at_betting_start(self):
+        now = self.kickoff - PRE_MATCH_BETTING_TIME - 100
+        self.scheduler.interval = 3600
+        self.assertEqual(self.scheduler.plan(self.index, [], now=now), 100)
+
+    def test_wake_at_full_time(self):
+        now = self.kickoff + MATCH_DURATION - 50
+        self.scheduler.interval = 3600
+        self.assertEqual(self.scheduler.plan(self.index, [self.round], now=now), 50)
+        self.assertFalse(self.scheduler.hot)
+
+    def test_hot_after_full_time(self):
+        now = self.kickoff + MATCH_DURATION + 10
+        self.scheduler.interval = 3600
+        self.assertEqual(self.scheduler.plan(self.index, [self.round], now=now), 30)
+        self.assertTrue(self.scheduler.hot)
+
+    def test_due(self):
+        self.scheduler.plan(self.index, [], now=1000)
+        self.assertFalse(self.scheduler.due(1059))
+        self.assertTrue(self.scheduler.due(1060))
+
+    def test_quota(self):
+        self.assertEqual(sum(self.scheduler.due(0) for _ in range(20)), 10)
+
+
 if __name__ == '__main__':
     unittest.main()